@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the bank module.
+
+Covers money parsing, every `Currency` operator, formatting, account lookups, and end to end transaction processing
+on synthetic data. Results are saved as JSON, and can be compared against a stored baseline to catch regressions.
+
+	./bench.py --sizes 1000,10000 --output results.json
+	./bench.py --baseline results.json
+
+`baseline.json` is a reference run of the default sizes, up to 10^6. Timings are absolute, so regressions only show
+against a baseline from the same machine; save your own with `--output` before making changes.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import contextlib
+import statistics
+from typing import Callable
+
+import bank
+from bank import Account, AccountRegistry, Currency, Ledger, parse_money, parse_many
+
+OPERATORS = {
+	"add": lambda c: c + 5,
+	"sub": lambda c: c - 5,
+	"mul": lambda c: c * 3,
+	"truediv": lambda c: c / 3,
+	"floordiv": lambda c: c // 3,
+	"mod": lambda c: c % 7,
+	"divmod": lambda c: divmod(c, 7),
+	"neg": lambda c: -c,
+	"pos": lambda c: +c,
+	"invert": lambda c: ~c,
+	"abs": lambda c: abs(c),
+}
+
+def measure(fn: Callable[[], None], repeat: int) -> "list[float]":
+	"""Run `fn` `repeat` times and return how long each run took, in seconds."""
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		times.append(time.perf_counter() - start)
+	return times
+
+def money_strings(rng: random.Random, n: int) -> "list[str]":
+	return [f"{'-' if rng.random() < 0.5 else ''}${rng.randint(0, 999999):,}.{rng.randint(0, 99):02d}" for _ in range(n)]
+
+def make_accounts(rng: random.Random, n: int) -> "list[Account]":
+	accounts = [Account("Scrooge McDuck", "100001", f"${n * 1000000:,}")]
+	accounts += [Account(f"Nephew {i}", str(200000 + i), f"${rng.randint(10, 5000)}") for i in range(n - 1)]
+	return accounts
+
+def make_transactions(rng: random.Random, accounts: "list[Account]", n: int) -> "list[tuple[int, str, Currency]]":
+	return [(i, rng.choice(accounts).account_id, Currency(-rng.randint(1, 50000))) for i in range(n)]
+
+def process(accounts: "list[Account]", rows: "list[tuple[int, str, Currency]]", settlement_window: int):
+	"""Run rows through `bank.process_transactions` on a fresh registry, with all output thrown away."""
+	previous = bank.registry, bank.VERBOSE
+	bank.registry = AccountRegistry(accounts)
+	bank.VERBOSE = False
+	try:
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			bank.process_transactions(iter(rows), report_every=0, settlement_window=settlement_window)
+	finally:
+		bank.registry, bank.VERBOSE = previous
+
+def benchmarks(n: int, seed: int) -> "dict[str, tuple[Callable[[], Callable[[], None]], int]]":
+	"""
+	Benchmarks for size `n`, as `name: (setup, ops)`. `setup` builds fresh input and returns the function to time, and
+	`ops` is how many operations one run of it does.
+	"""
+	rng = random.Random(seed)
+	strings = money_strings(rng, n)
+	values = [Currency(rng.randint(-10 ** 8, 10 ** 8)) for _ in range(n)]
+
+	def loop(fn, items):
+		def run():
+			for item in items:
+				fn(item)
+		return lambda: run
+
+	result = {
+		"parse_money": (loop(parse_money, strings), n),
+		"parse_many": (lambda: lambda: parse_many(strings), n),
+		"str": (loop(str, values), n),
+	}
+	for name, op in OPERATORS.items():
+		result[f"currency_{name}"] = (loop(op, values), n)
+
+	accounts = make_accounts(rng, n)
+	registry = AccountRegistry(accounts)
+	ids = [rng.choice(accounts).account_id for _ in range(n)]
+
+	def lookups():
+		def run():
+			previous = bank.registry
+			bank.registry = registry
+			try:
+				for account_id in ids:
+					bank.get_account(account_id)
+			finally:
+				bank.registry = previous
+		return run
+	result["get_account"] = (lookups, n)
+
+	rows = make_transactions(rng, accounts, n)
+
+	def ledger_apply():
+		ledger = Ledger(make_accounts(random.Random(seed), n))
+		batch = [(account_id, amount) for _, account_id, amount in rows]
+		return lambda: ledger.apply(batch)
+
+	def processing(settlement_window: int):
+		def setup():
+			fresh = make_accounts(random.Random(seed), n)
+			return lambda: process(fresh, rows, settlement_window)
+		return setup
+
+	result["ledger_apply"] = (ledger_apply, n)
+	result["process_settled"] = (processing(n), n)
+	if n <= 1000:
+		# the row by row fan-out is O(accounts) per row, so it's only practical for small sizes
+		result["process_row_by_row"] = (processing(0), n)
+	return result
+
+def run(sizes: "list[int]", repeat: int, seed: int, only: "list[str]"=None) -> dict:
+	results = {}
+	for n in sizes:
+		for name, (setup, ops) in benchmarks(n, seed).items():
+			if only and not any(name.startswith(prefix) for prefix in only):
+				continue
+			# setup again before every run so that stateful benchmarks start from the same state
+			times = [measure(setup(), 1)[0] for _ in range(repeat)]
+			best = min(times)
+			results[f"{name}@{n}"] = {
+				"name": name,
+				"size": n,
+				"best": best,
+				"median": statistics.median(times),
+				"ns_per_op": best / ops * 1e9,
+			}
+			print(f"{name.ljust(20)} n={str(n).ljust(8)} best {best * 1000:10.3f} ms  {best / ops * 1e9:10.1f} ns/op", file=sys.stderr)
+	return {
+		"meta": {
+			"python": platform.python_version(),
+			"implementation": platform.python_implementation(),
+			"machine": platform.machine(),
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"repeat": repeat,
+			"seed": seed,
+		},
+		"results": results,
+	}
+
+def compare(current: dict, baseline: dict, tolerance: float) -> "list[str]":
+	"""Print a comparison of `current` against `baseline`, and return the names of benchmarks that regressed."""
+	regressions = []
+	for key, result in current["results"].items():
+		if key not in baseline["results"]:
+			continue
+		before = baseline["results"][key]["best"]
+		ratio = result["best"] / before if before > 0 else float("inf")
+		flag = ""
+		if ratio > 1 + tolerance:
+			flag = "REGRESSION"
+			regressions.append(key)
+		elif ratio < 1 - tolerance:
+			flag = "faster"
+		print(f"{key.ljust(30)} {before * 1000:10.3f} ms -> {result['best'] * 1000:10.3f} ms  x{ratio:6.2f} {flag}")
+	return regressions
+
+def main(argv: "list[str]"=None) -> int:
+	parser = argparse.ArgumentParser(description="Benchmark the bank module.")
+	parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="Comma separated numbers of accounts and transactions.")
+	parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark. The best run is what gets compared.")
+	parser.add_argument("--seed", type=int, default=215)
+	parser.add_argument("--only", help="Comma separated benchmark name prefixes to run.")
+	parser.add_argument("--output", metavar="PATH", help="Save results as JSON.")
+	parser.add_argument("--baseline", metavar="PATH", help="Compare results against a previously saved run.")
+	parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown ratio over the baseline that counts as a regression.")
+	args = parser.parse_args(argv)
+
+	sizes = [int(size) for size in args.sizes.split(",")]
+	only = args.only.split(",") if args.only else None
+	current = run(sizes, args.repeat, args.seed, only)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(current, f, indent="\t")
+	if args.baseline:
+		with open(args.baseline, "r") as f:
+			baseline = json.load(f)
+		regressions = compare(current, baseline, args.tolerance)
+		if regressions:
+			print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
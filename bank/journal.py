@@ -0,0 +1,201 @@
+"""
+Write-ahead journal and snapshots for bank account state.
+
+The journal is an append-only file of length-prefixed binary records, one per committed transaction. A snapshot is a
+compact columnar dump of every account at some journal sequence number. Recovery maps the latest snapshot and replays
+only the journal records after it, and taking a snapshot truncates the journal, so restart time depends on how much
+happened since the last snapshot rather than on the whole history.
+"""
+
+import os
+import sys
+import mmap
+import zlib
+import struct
+import threading
+from array import array
+from typing import Iterable, Iterator, Optional
+
+# payload length, crc32 of payload
+RECORD_HEADER = struct.Struct("<II")
+# sequence number, kind, amount in cents, transaction count. Followed by the utf-8 account id.
+RECORD = struct.Struct("<QBqI")
+KIND_TRANSACTION = 0
+KIND_PENALTY = 1
+
+SNAPSHOT_MAGIC = b"BANKSNP1"
+# magic, byte order, sequence number, account count
+SNAPSHOT_HEADER = struct.Struct("<8s8sQQ")
+
+class Snapshot:
+	"""
+	A snapshot file, mapped into memory. The balance and counter columns are memoryviews straight into the map, and
+	ids and holders are only decoded when asked for.
+	"""
+
+	def __init__(self, path: str):
+		with open(path, "rb") as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, byteorder, self.seq, self.count = SNAPSHOT_HEADER.unpack_from(self.map, 0)
+		if magic != SNAPSHOT_MAGIC:
+			raise ValueError(f"{path} is not a snapshot")
+		if byteorder.rstrip(b"\0").decode() != sys.byteorder:
+			raise ValueError(f"{path} was written on a machine with a different byte order")
+		view = memoryview(self.map)
+		offset = SNAPSHOT_HEADER.size
+		columns = []
+		for _ in range(4):
+			columns.append(view[offset:offset + 8 * self.count].cast("q"))
+			offset += 8 * self.count
+		self.balance, self.count_withdraw, self.count_deposit, self.count_penalty = columns
+		self.id_offsets = view[offset:offset + 8 * (self.count + 1)].cast("Q")
+		offset += 8 * (self.count + 1)
+		self.holder_offsets = view[offset:offset + 8 * (self.count + 1)].cast("Q")
+		offset += 8 * (self.count + 1)
+		self.ids = view[offset:offset + self.id_offsets[-1]]
+		offset += self.id_offsets[-1]
+		self.holders = view[offset:offset + self.holder_offsets[-1]]
+
+	def account_id(self, i: int) -> str:
+		return bytes(self.ids[self.id_offsets[i]:self.id_offsets[i + 1]]).decode()
+
+	def holder(self, i: int) -> str:
+		return bytes(self.holders[self.holder_offsets[i]:self.holder_offsets[i + 1]]).decode()
+
+	def __len__(self) -> int:
+		return self.count
+
+	def __iter__(self) -> "Iterator[tuple[str, str, int, int, int, int]]":
+		"""Yield `(account_id, holder, balance, withdraws, deposits, penalties)` for every account."""
+		for i in range(self.count):
+			yield self.account_id(i), self.holder(i), self.balance[i], self.count_withdraw[i], self.count_deposit[i], self.count_penalty[i]
+
+	def close(self):
+		for column in (self.balance, self.count_withdraw, self.count_deposit, self.count_penalty, self.id_offsets, self.holder_offsets, self.ids, self.holders):
+			column.release()
+		self.map.close()
+
+def write_snapshot(path: str, seq: int, rows: "Iterable[tuple[str, str, int, int, int, int]]"):
+	"""
+	Write `(account_id, holder, balance, withdraws, deposits, penalties)` rows as a snapshot at journal sequence
+	number `seq`. The file is replaced atomically, so a crash leaves either the old snapshot or the new one.
+	"""
+	columns = [array("q") for _ in range(4)]
+	id_offsets = array("Q", [0])
+	holder_offsets = array("Q", [0])
+	ids = bytearray()
+	holders = bytearray()
+	for account_id, holder, *values in rows:
+		for column, value in zip(columns, values):
+			column.append(int(value))
+		ids += account_id.encode()
+		holders += holder.encode()
+		id_offsets.append(len(ids))
+		holder_offsets.append(len(holders))
+	tmp_path = f"{path}.tmp"
+	with open(tmp_path, "wb") as f:
+		f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, sys.byteorder.encode(), seq, len(columns[0])))
+		for column in columns:
+			column.tofile(f)
+		id_offsets.tofile(f)
+		holder_offsets.tofile(f)
+		f.write(ids)
+		f.write(holders)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+
+def scan_journal(path: str) -> "Iterator[tuple[int, int, str, int, int, bool]]":
+	"""
+	Yield `(end offset, seq, account_id, amount, count, penalty)` for every record. Scanning stops at the first torn or
+	corrupt record, which is what a crash in the middle of a write leaves behind.
+	"""
+	if not os.path.exists(path) or os.path.getsize(path) == 0:
+		return
+	with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+		offset = 0
+		end = len(m)
+		while offset + RECORD_HEADER.size <= end:
+			length, crc = RECORD_HEADER.unpack_from(m, offset)
+			start = offset + RECORD_HEADER.size
+			if start + length > end or length < RECORD.size:
+				return
+			payload = m[start:start + length]
+			if zlib.crc32(payload) != crc:
+				return
+			seq, kind, amount, count = RECORD.unpack_from(payload, 0)
+			offset = start + length
+			yield offset, seq, payload[RECORD.size:].decode(), amount, count, kind == KIND_PENALTY
+
+def read_journal(path: str, after_seq: int=0) -> "Iterator[tuple[int, str, int, int, bool]]":
+	"""Yield `(seq, account_id, amount, count, penalty)` for every intact record after `after_seq`."""
+	for _, seq, *record in scan_journal(path):
+		if seq > after_seq:
+			yield (seq, *record)
+
+class Journal:
+	"""
+	Journal and snapshot files in `directory`. Records are fsynced in groups of `group_size`, so a crash can lose at
+	most the last group of records that was not yet synced.
+	"""
+
+	def __init__(self, directory: str, group_size: int=64):
+		assert group_size > 0
+		os.makedirs(directory, exist_ok=True)
+		self.journal_path = os.path.join(directory, "journal.bin")
+		self.snapshot_path = os.path.join(directory, "snapshot.bin")
+		self.group_size = group_size
+		self.seq = 0
+		self.unsynced = 0
+		self.f = open(self.journal_path, "ab")
+		self.lock = threading.Lock()
+
+	def load_snapshot(self) -> Optional[Snapshot]:
+		if not os.path.exists(self.snapshot_path):
+			return None
+		return Snapshot(self.snapshot_path)
+
+	def replay(self, after_seq: int) -> "Iterator[tuple[int, str, int, int, bool]]":
+		"""
+		Yield the journal records after `after_seq`, and continue numbering records from the last one. Anything after
+		the last intact record is cut off, so new records don't end up behind a torn one.
+		"""
+		self.seq = after_seq
+		valid_end = 0
+		for valid_end, seq, *record in scan_journal(self.journal_path):
+			if seq > after_seq:
+				self.seq = seq
+				yield (seq, *record)
+		self.f.flush()
+		self.f.truncate(valid_end)
+
+	def append(self, account_id: str, amount: int, count: int=1, penalty: bool=False) -> int:
+		with self.lock:
+			self.seq += 1
+			payload = RECORD.pack(self.seq, KIND_PENALTY if penalty else KIND_TRANSACTION, amount, count) + account_id.encode()
+			self.f.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+			self.f.write(payload)
+			self.unsynced += 1
+			if self.unsynced >= self.group_size:
+				self.sync_locked()
+			return self.seq
+
+	def sync(self):
+		with self.lock:
+			self.sync_locked()
+
+	def sync_locked(self):
+		self.f.flush()
+		os.fsync(self.f.fileno())
+		self.unsynced = 0
+
+	def checkpoint(self, rows: "Iterable[tuple[str, str, int, int, int, int]]"):
+		"""Write a snapshot of `rows` at the current sequence number, then truncate the journal."""
+		self.sync()
+		write_snapshot(self.snapshot_path, self.seq, rows)
+		self.f.truncate(0)
+		self.sync()
+
+	def close(self):
+		self.sync()
+		self.f.close()
@@ -0,0 +1,341 @@
+"""
+Parallel transaction processing for `Ledger` batches.
+
+Accounts are partitioned by account id across worker processes, and each worker owns a `Ledger` holding only its own
+accounts. A batch is streamed through in windows of up to one piece per worker, and each window goes through two
+rounds before the next one is read:
+
+1. Routing. Each piece, either a slice of the rows or a byte range of a transactions file, is sorted by a worker into
+   one shard per partition.
+2. Applying. Every worker gets its shards of the window's pieces, in order, and applies them to its own accounts. A
+   transfer between two partitions is split in two: the source's owner withdraws and tells the destination's owner
+   over a queue whether it went through, and the destination's owner waits for that before depositing. Both go
+   through the rows in the same order, so neither can be waiting on the other.
+
+Only one window is in memory at a time, however big the batch is. So that an unknown account or a bad row is still
+raised before anything is committed, the batch is checked in a streaming pass first. The parent only forwards shards
+as bytes, and afterwards copies back only the accounts that changed. The result is the same as `Ledger.apply` on one
+ledger, however the work was scheduled.
+
+The nephew rules in `bank.main` can't be partitioned like this, because every row moves money through Scrooge and
+depends on the rows before it.
+"""
+
+import os
+import csv
+import json
+import zlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+from array import array
+from typing import Iterable, Iterator
+
+from bank import Currency, Ledger, TransactionException
+
+# kinds of routed rows
+DEPOSIT_OR_WITHDRAW = 0
+# a transfer within one partition. The peer is the destination's local slot.
+TRANSFER = 1
+# the source side of a transfer between partitions. The peer is the destination's partition.
+TRANSFER_OUT = 2
+# the destination side. The peer is the source's partition.
+TRANSFER_IN = 3
+
+def partition_of(account_id: str, partitions: int) -> int:
+	"""Stable partition number for an account id. Unlike `hash`, this is the same in every process."""
+	return zlib.crc32(account_id.encode()) % partitions
+
+def read_range(path: str, start: int, end: int, fmt: str="csv") -> "list[tuple[str, int]]":
+	"""`(account_id, amount)` rows of the lines that start between byte `start` and `end` of a transactions file."""
+	with open(path, "rb") as f:
+		if start > 0:
+			# the line running over `start` belongs to the range before
+			f.seek(start - 1)
+			f.readline()
+		lines = []
+		while f.tell() < end:
+			line = f.readline()
+			if not line:
+				break
+			lines.append(line.decode())
+	rows = []
+	if fmt == "jsonl":
+		for line in lines:
+			if line.strip():
+				row = json.loads(line)
+				rows.append((str(row["account_id"]), int(Currency(str(row["amount"])))))
+		return rows
+	for row in csv.reader(lines):
+		if not row:
+			continue
+		if len(row) != 2:
+			raise ValueError(f"malformed row in {path}: {','.join(row)}")
+		if start == 0 and not rows and row[0].strip() == "account_id":
+			continue
+		rows.append((row[0].strip(), int(Currency(row[1].strip()))))
+	return rows
+
+class Worker:
+	"""One partition of accounts, served over a pipe until told to stop."""
+
+	def __init__(self, partition: int, ids: "list[str]", partitions: array, accounts: "list[tuple[str, str, int, int, int, int]]", inboxes: list):
+		self.partition = partition
+		self.slots = {account_id: slot for slot, account_id in enumerate(ids)}
+		self.partitions = partitions
+		self.workers = len(inboxes)
+		self.inboxes = inboxes
+		# transfer outcomes that came in before they were needed, by (piece, row)
+		self.outcomes: "dict[tuple[int, int], bool]" = {}
+		# every account's slot in its own partition's ledger
+		self.local = array("q", bytes(8 * len(ids)))
+		counts = [0] * self.workers
+		for slot, p in enumerate(partitions):
+			self.local[slot] = counts[p]
+			counts[p] += 1
+		self.ledger = Ledger()
+		for account_id, holder, balance, withdraws, deposits, penalties in accounts:
+			slot = self.ledger.add(holder, account_id, balance)
+			self.ledger.count_withdraw[slot] = withdraws
+			self.ledger.count_deposit[slot] = deposits
+			self.ledger.count_penalty[slot] = penalties
+
+	def check(self, source: tuple) -> int:
+		"""Read a piece of a file like `route` does, and return how many rows it has. Raises like `route`."""
+		rows = read_range(*source[1:])
+		slots = self.slots
+		for row in rows:
+			slots[row[0]]
+		return len(rows)
+
+	def route(self, source: tuple) -> "tuple[int, list[tuple[bytes, ...]]]":
+		"""
+		Sort a piece of a batch into shards of `(rows, local slots, amounts, kinds, peers)` per partition. The piece is
+		`("rows", rows)` or `("file", path, start, end, fmt)`. Raises `KeyError` for an unknown account.
+		"""
+		rows = source[1] if source[0] == "rows" else read_range(*source[1:])
+		shards = [tuple(array("q") for _ in range(5)) for _ in range(self.workers)]
+		slots, partitions, local = self.slots, self.partitions, self.local
+		for i, row in enumerate(rows):
+			slot = slots[row[0]]
+			p = partitions[slot]
+			amount = int(row[1])
+			if len(row) <= 2:
+				kind, peer = DEPOSIT_OR_WITHDRAW, 0
+			else:
+				dest = slots[row[2]]
+				q = partitions[dest]
+				if q == p:
+					kind, peer = TRANSFER, local[dest]
+				else:
+					kind, peer = TRANSFER_OUT, q
+					for column, value in zip(shards[q], (i, local[dest], amount, TRANSFER_IN, p)):
+						column.append(value)
+			for column, value in zip(shards[p], (i, local[slot], amount, kind, peer)):
+				column.append(value)
+		return len(rows), [tuple(column.tobytes() for column in shard) for shard in shards]
+
+	def outcome(self, piece: int, i: int) -> bool:
+		"""Whether the withdrawal of a transfer into this partition went through, waiting for it if needed."""
+		while (piece, i) not in self.outcomes:
+			sent_piece, sent_i, ok = self.inboxes[self.partition].get()
+			self.outcomes[(sent_piece, sent_i)] = ok
+		return self.outcomes.pop((piece, i))
+
+	def apply(self, shards: "list[tuple[bytes, ...]]") -> "tuple[list[tuple], bytes, tuple[bytes, ...]]":
+		"""
+		Apply this partition's shard of every piece, in order. Returns the rejected rows as `(piece, row, account_id,
+		amount, message, penalty)`, and the local slots that changed with their balances and counters.
+		"""
+		ledger = self.ledger
+		changed = set()
+		rejected = []
+		for piece, shard in enumerate(shards):
+			rows, slots, amounts, kinds, peers = (array("q", column) for column in shard)
+			changed.update(slots)
+			failed = []
+			start = 0
+			# the deposits and withdrawals between two transfer rows are applied as one run, like `Ledger.apply` does
+			for j in itertools.compress(range(len(kinds)), kinds):
+				failed += ledger.apply_slots(slots, amounts, start, j)
+				start = j + 1
+				slot = slots[j]
+				amount = amounts[j]
+				if kinds[j] == TRANSFER_IN:
+					if self.outcome(piece, rows[j]):
+						ledger.deposit(slot, amount)
+					continue
+				try:
+					ledger.withdraw(slot, amount)
+					ok = True
+				except TransactionException as e:
+					failed.append((j, e))
+					ok = False
+				if kinds[j] == TRANSFER_OUT:
+					self.inboxes[peers[j]].put((piece, rows[j], ok))
+				elif ok:
+					ledger.deposit(peers[j], amount)
+					changed.add(peers[j])
+			failed += ledger.apply_slots(slots, amounts, start, len(slots))
+			rejected += [(piece, rows[j], e.account.account_id, int(e.amount), e.message, e.penalty) for j, e in failed]
+		touched = array("q", sorted(changed))
+		columns = tuple(array("q", [column[slot] for slot in touched]).tobytes() for column in (ledger.balance, ledger.count_withdraw, ledger.count_deposit, ledger.count_penalty))
+		return rejected, touched.tobytes(), columns
+
+def serve(conn, *args):
+	"""Run a `Worker`, sending back `("ok", result)` or `("error", exception)` for every command."""
+	worker = Worker(*args)
+	while True:
+		command, *params = conn.recv()
+		if command == "stop":
+			conn.close()
+			return
+		try:
+			conn.send(("ok", getattr(worker, command)(*params)))
+		except Exception as e:
+			conn.send(("error", e))
+
+class ParallelLedger:
+	"""
+	Runs `Ledger.apply` across `workers` processes. `ledger` is updated with the accounts that changed after every
+	`apply`. Batches are routed and applied `chunk_size` rows per worker at a time, or `chunk_bytes` of file per worker
+	with `apply_file`.
+
+	Use it as a context manager, or call `close` when done, so the worker processes exit. An error in a worker is
+	raised in the parent. If it happens while applying, the engine is closed, because the workers' state can't be
+	trusted anymore.
+	"""
+
+	def __init__(self, ledger: Ledger, workers: int=None, chunk_size: int=100000, chunk_bytes: int=4 * 1024 * 1024):
+		self.ledger = ledger
+		self.workers = workers or os.cpu_count() or 1
+		self.chunk_size = chunk_size
+		self.chunk_bytes = chunk_bytes
+		self.partitions = array("H", [partition_of(account_id, self.workers) for account_id in ledger.ids])
+		self.members = [array("q") for _ in range(self.workers)]
+		for slot, p in enumerate(self.partitions):
+			self.members[p].append(slot)
+
+		inboxes = [multiprocessing.Queue() for _ in range(self.workers)]
+		self.conns = []
+		self.processes = []
+		for p in range(self.workers):
+			accounts = [(ledger.ids[s], ledger.holders[s], ledger.balance[s], ledger.count_withdraw[s], ledger.count_deposit[s], ledger.count_penalty[s]) for s in self.members[p]]
+			parent_conn, child_conn = multiprocessing.Pipe()
+			process = multiprocessing.Process(target=serve, args=(child_conn, p, ledger.ids, self.partitions, accounts, inboxes), daemon=True)
+			process.start()
+			child_conn.close()
+			self.conns.append(parent_conn)
+			self.processes.append(process)
+
+	def __enter__(self) -> "ParallelLedger":
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		for conn in self.conns:
+			try:
+				conn.send(("stop",))
+			except OSError:
+				pass
+			conn.close()
+		for process in self.processes:
+			process.join()
+		self.conns = []
+		self.processes = []
+
+	def call(self, commands: "dict[int, tuple]", fatal: bool=False) -> "dict[int, object]":
+		"""
+		Send a command to each of some workers and wait for all of their results. An error in a worker is raised here.
+		If it's `fatal`, the other workers may be waiting on the one that failed, so they're all stopped instead of
+		waited for.
+		"""
+		for p, command in commands.items():
+			self.conns[p].send(command)
+		waiting = {self.conns[p]: p for p in commands}
+		results = {}
+		errors = {}
+		while waiting:
+			for conn in multiprocessing.connection.wait(list(waiting)):
+				p = waiting.pop(conn)
+				try:
+					status, result = conn.recv()
+				except EOFError:
+					status, result = "error", RuntimeError(f"worker {p} exited")
+				if status == "ok":
+					results[p] = result
+					continue
+				if fatal:
+					for process in self.processes:
+						process.terminate()
+					self.close()
+					raise result
+				errors[p] = result
+		if errors:
+			raise errors[min(errors)]
+		return results
+
+	def run(self, windows: "Iterator[list[tuple]]") -> "list[tuple[int, TransactionException]]":
+		"""
+		Route and apply windows of pieces, up to one piece per worker each, one window at a time. The batch should have
+		been checked already, since the windows before an error stay applied.
+		"""
+		columns = (self.ledger.balance, self.ledger.count_withdraw, self.ledger.count_deposit, self.ledger.count_penalty)
+		rejected = []
+		done = 0
+		for window in windows:
+			results = self.call({k: ("route", piece) for k, piece in enumerate(window)})
+			pieces = range(len(results))
+			base = []
+			for k in pieces:
+				base.append(done)
+				done += results[k][0]
+			busy = {p: ("apply", [results[k][1][p] for k in pieces]) for p in range(self.workers) if any(results[k][1][p][0] for k in pieces)}
+			for p, (worker_rejected, touched, values) in self.call(busy, fatal=True).items():
+				rejected.extend((base[piece] + i, *rest) for piece, i, *rest in worker_rejected)
+				members = self.members[p]
+				touched = [members[slot] for slot in array("q", touched)]
+				for column, column_values in zip(columns, values):
+					for slot, value in zip(touched, array("q", column_values)):
+						column[slot] = value
+		rejected.sort(key=lambda r: r[0])
+		return [(i, TransactionException(self.ledger[account_id], Currency(amount), message, penalty)) for i, account_id, amount, message, penalty in rejected]
+
+	def apply(self, transactions: "Iterable[tuple]") -> "list[tuple[int, TransactionException]]":
+		"""Same as `Ledger.apply`, but run in parallel."""
+		rows = transactions if isinstance(transactions, list) else list(transactions)
+		slots = self.ledger.slots
+		for row in rows:
+			slots[row[0]]
+			int(row[1])
+			if len(row) > 2:
+				slots[row[2]]
+
+		def windows() -> "Iterator[list[tuple]]":
+			for start in range(0, len(rows), self.chunk_size * self.workers):
+				end = min(start + self.chunk_size * self.workers, len(rows))
+				size = -(-(end - start) // self.workers)
+				yield [("rows", rows[k:min(k + size, end)]) for k in range(start, end, size)]
+		return self.run(windows())
+
+	def file_windows(self, path: str, fmt: str) -> "Iterator[list[tuple]]":
+		size = os.path.getsize(path)
+		for start in range(0, size, self.chunk_bytes * self.workers):
+			end = min(start + self.chunk_bytes * self.workers, size)
+			yield [("file", path, offset, min(offset + self.chunk_bytes, end), fmt) for offset in range(start, end, self.chunk_bytes)]
+
+	def apply_file(self, path: str, fmt: str="csv", validate: bool=True) -> "list[tuple[int, TransactionException]]":
+		"""
+		Apply the `account_id,amount` rows of a CSV or JSON lines file, like `apply`. The workers read and parse their
+		own byte ranges of the file, so the parent never handles the rows. Row numbers count data rows from 0.
+
+		With `validate`, the workers read through the file once first, so that an unknown account or a bad row is
+		raised before anything is committed. Without it, the file is only read once, and the rows before a bad one stay
+		applied.
+		"""
+		if validate:
+			for window in self.file_windows(path, fmt):
+				self.call({k: ("check", piece) for k, piece in enumerate(window)})
+		return self.run(self.file_windows(path, fmt))
@@ -1,5 +1,16 @@
 import unittest
-from bank import Currency
+import random
+import io
+import csv
+import json
+import tempfile
+import os
+import sys
+import threading
+import contextlib
+import bank
+import parallel
+from bank import Currency, parse_many, Account, AccountRegistry, Ledger, Settlement, TransactionException, read_transactions, parse_transactions
 
 class TestCurrency(unittest.TestCase):
 	def test_operations(self):
@@ -36,6 +47,353 @@ class TestCurrency(unittest.TestCase):
 		self.assertEqual(Currency("$2"), 200)
 		self.assertEqual(Currency("-$2"), -200)
 		self.assertEqual(Currency("$2.56"), 256)
+		self.assertEqual(Currency("-$2.56"), -256)
+		self.assertEqual(Currency("$1,000,000"), 100000000)
+		self.assertEqual(Currency("$2.5"), 250)
+		self.assertEqual(Currency(".05"), 5)
+		with self.assertRaises(ValueError):
+			Currency("$")
+		self.assertEqual(list(parse_many(["$2", "-$2.56", "$2"])), [200, -256, 200])
+
+	def test_str(self):
+		self.assertEqual(str(Currency("$1,000,000")), "$1000000.00")
+		self.assertEqual(str(Currency("-$2.05")), "-$2.05")
+		self.assertEqual(str(Currency(7)), "$0.07")
+
+	def test_divmod(self):
+		q, r = divmod(Currency(705), 100)
+		self.assertEqual((q, r), (7, 5))
+		self.assertIsInstance(q, Currency)
+		self.assertIsInstance(r, Currency)
+		self.assertIsInstance(-Currency(5), Currency)
+
+class TestLedger(unittest.TestCase):
+	def test_matches_account(self):
+		accounts = [Account("A", "1", "$100"), Account("B", "2", "$50.25")]
+		ledger = Ledger(accounts)
+		rows = [("1", Currency("-$5")), ("2", Currency("$3")), ("1", Currency("-$20")), ("2", Currency("-$5.02"))]
+		rejected = ledger.apply(rows)
+		for account_id, amount in rows:
+			account = accounts[0] if account_id == "1" else accounts[1]
+			try:
+				if amount < 0:
+					account.withdraw(-amount)
+				else:
+					account.deposit(amount)
+			except TransactionException:
+				pass
+		for account in accounts:
+			view = ledger[account.account_id]
+			self.assertEqual(view.balance, account.balance)
+			self.assertEqual(view.count_withdraw, account.count_withdraw)
+			self.assertEqual(view.count_deposit, account.count_deposit)
+		self.assertEqual([i for i, _ in rejected], [2])
+		self.assertTrue(rejected[0][1].penalty)
+
+	def test_exceptions(self):
+		ledger = Ledger([Account("A", "1", "$100")])
+		with self.assertRaises(TransactionException):
+			ledger["1"].withdraw(Currency("$0"))
+		with self.assertRaises(TransactionException):
+			ledger["1"].deposit(Currency("-$1"))
+		self.assertEqual(ledger["1"].apply_penalty(), 500)
+		self.assertEqual(ledger["1"].balance, Currency("$95"))
+		self.assertEqual(ledger["1"].count_penalty, 1)
+
+	def test_main(self):
+		def run(*argv):
+			registry = bank.registry
+			bank.registry = AccountRegistry(Account(a.holder, a.account_id, a.balance) for a in registry)
+			out = io.StringIO()
+			try:
+				with contextlib.redirect_stdout(out):
+					bank.main(list(argv))
+			finally:
+				bank.registry = registry
+			return out.getvalue()
+		self.assertEqual(run("--ledger", "--settlement-window", "2"), run("--settlement-window", "2"))
+		self.assertEqual(run("--ledger"), run())
+
+class TestAccountRegistry(unittest.TestCase):
+	def test_add_remove(self):
+		for shard_prefix_len in (0, 2):
+			registry = AccountRegistry([Account("A", "100001", "$1"), Account("B", "700007", "$2")], shard_prefix_len=shard_prefix_len)
+			self.assertEqual(registry["700007"].holder, "B")
+			self.assertEqual(len(registry), 2)
+			registry.remove("700007")
+			self.assertNotIn("700007", registry)
+			self.assertIsNone(registry.get("700007"))
+			with self.assertRaises(KeyError):
+				registry["700007"]
+			registry.add(Account("C", "700007", "$3"))
+			self.assertEqual(registry["700007"].holder, "C")
+			self.assertEqual([a.holder for a in registry], ["A", "C"])
+			with self.assertRaises(ValueError):
+				registry.add(Account("D", "700007", "$3"))
+
+	def test_shards(self):
+		registry = AccountRegistry([Account("A", "100001", "$1"), Account("B", "100002", "$2"), Account("C", "200001", "$2")], shard_prefix_len=1)
+		self.assertEqual(list(registry.shard("1")), ["100001", "100002"])
+		self.assertEqual(registry.shard("3"), {})
+
+class TestSettlement(unittest.TestCase):
+	def make_registry(self):
+		accounts = [Account("Scrooge", "0", "$2,000")]
+		accounts += [Account(f"Nephew {i}", str(i), f"${100 + i * 7}") for i in range(1, 40)]
+		return AccountRegistry(accounts)
+
+	def process(self, registry, rows, settlement=None):
+		scrooge = registry["0"]
+		for account_id, amount in rows:
+			account = registry[account_id]
+			if settlement:
+				settlement.flush_account(account)
+			try:
+				account.withdraw(amount)
+				if settlement:
+					settlement.fan_out(account, amount)
+					continue
+				for a in registry:
+					if a.account_id == account.account_id or a.account_id == scrooge.account_id:
+						continue
+					scrooge.withdraw(amount)
+					a.deposit(amount)
+			except TransactionException as e:
+				if e.penalty:
+					amount = account.apply_penalty()
+					if settlement:
+						settlement.deposit(scrooge, amount)
+					else:
+						scrooge.deposit(amount)
+		if settlement:
+			settlement.flush()
+
+	def test_same_as_row_by_row(self):
+		random.seed(2021)
+		rows = [(str(random.randint(0, 39)), Currency(random.randint(1, 1500))) for _ in range(300)]
+		expected = self.make_registry()
+		self.process(expected, rows)
+		actual = self.make_registry()
+		self.process(actual, rows, Settlement(actual, actual["0"]))
+		for a, b in zip(expected, actual):
+			self.assertEqual((a.balance, a.count_withdraw, a.count_deposit, a.count_penalty), (b.balance, b.count_withdraw, b.count_deposit, b.count_penalty))
+
+class TestLocking(unittest.TestCase):
+	def test_threaded_transfers(self):
+		accounts = [Account(f"Duck {i}", str(i), "$1,000,000") for i in range(4)]
+		interval = sys.getswitchinterval()
+		sys.setswitchinterval(1e-6)
+		def run(k):
+			rng = random.Random(k)
+			for _ in range(2000):
+				source, dest = rng.sample(accounts, 2)
+				bank.transfer(source, dest, Currency(rng.randint(1, 500)))
+				if k % 2:
+					accounts[k % 4].deposit(Currency(1))
+		threads = [threading.Thread(target=run, args=(k,)) for k in range(8)]
+		try:
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join(60)
+		finally:
+			sys.setswitchinterval(interval)
+		self.assertFalse(any(t.is_alive() for t in threads))
+		# every transfer took money out of one account and put all of it into another
+		self.assertEqual(sum(a.balance for a in accounts), Currency("$4,000,000") + 4 * 2000)
+		self.assertEqual(sum(a.count_withdraw for a in accounts), 8 * 2000)
+		self.assertEqual(sum(a.count_deposit for a in accounts), 8 * 2000 + 4 * 2000)
+
+	def test_transfer_waits_for_locks(self):
+		a, b = Account("A", "1", "$100"), Account("B", "2", "$100")
+		done = threading.Event()
+		def run():
+			bank.transfer(b, a, Currency(1))
+			done.set()
+		t = threading.Thread(target=run)
+		with bank.locked(a, b):
+			t.start()
+			self.assertFalse(done.wait(0.1))
+			# the locks are reentrant, so the thread holding them can still commit
+			a.deposit(Currency(1))
+		t.join(5)
+		self.assertTrue(done.is_set())
+		self.assertEqual((a.balance, b.balance), (Currency("$100.02"), Currency("$99.99")))
+
+class TestIngest(unittest.TestCase):
+	def test_read_csv(self):
+		f = io.StringIO("account_id,amount\n900009,-$2\nbad\n\n700007,-$1.50\n")
+		self.assertEqual(list(read_transactions(f)), [(2, "900009", "-$2"), (3, None, "bad"), (5, "700007", "-$1.50")])
+
+	def test_read_jsonl(self):
+		f = io.StringIO('{"account_id": "900009", "amount": "-$2"}\nnope\n')
+		self.assertEqual(list(read_transactions(f, "jsonl")), [(1, "900009", "-$2"), (2, None, "nope")])
+
+	def test_parse(self):
+		out = io.StringIO()
+		rows = [(1, "900009", "-$2"), (2, None, "bad"), (3, "123", "-$1"), (4, "700007", "-$x")]
+		self.assertEqual(list(parse_transactions(rows, csv.writer(out))), [(1, "900009", -200)])
+		self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+	def test_process(self):
+		registry, verbose = bank.registry, bank.VERBOSE
+		bank.registry = AccountRegistry([Account("Scrooge", "100001", "$1,000"), Account("Huey", "1", "$100")])
+		bank.VERBOSE = False
+		results, rejected = io.StringIO(), io.StringIO()
+		try:
+			with contextlib.redirect_stdout(io.StringIO()):
+				bank.process_transactions([(1, "1", Currency("-$5")), (2, "1", Currency("$5")), (3, "1", Currency("$0")), (4, "1", Currency("-$90"))], 0, results=csv.writer(results), rejected=csv.writer(rejected))
+		finally:
+			bank.registry, bank.VERBOSE = registry, verbose
+		statuses = [row[3] for row in csv.reader(io.StringIO(results.getvalue()))]
+		self.assertEqual(statuses[:3], ["ok", "not a withdrawal", "not a withdrawal"])
+		self.assertNotEqual(statuses[3], "ok")
+		self.assertEqual([row[0] for row in csv.reader(io.StringIO(rejected.getvalue()))], ["2", "3", "4"])
+
+class TestJournal(unittest.TestCase):
+	def setUp(self):
+		self.registry = bank.registry
+		bank.registry = AccountRegistry([Account("Scrooge", "0", "$1,000"), Account("Huey", "1", "$100")])
+		self.dir = tempfile.TemporaryDirectory()
+
+	def tearDown(self):
+		if bank.journal:
+			bank.journal.close()
+		bank.journal = None
+		bank.registry = self.registry
+		self.dir.cleanup()
+
+	def state(self):
+		return [(a.account_id, a.holder, a.balance, a.count_withdraw, a.count_deposit, a.count_penalty) for a in bank.registry]
+
+	def test_recover_tail(self):
+		bank.restore(self.dir.name, group_size=1)
+		bank.get_account("1").withdraw(Currency("$5"))
+		bank.get_account("0").deposit(Currency("$5"))
+		bank.get_account("1").apply_penalty()
+		bank.get_account("0").settle(Currency("-$3"), 3)
+		expected = self.state()
+		# crash: the journal is never checkpointed, and the last write is torn
+		bank.journal.f.write(b"\x20\x00\x00")
+		bank.journal.close()
+		bank.journal = None
+		bank.registry = AccountRegistry()
+		bank.restore(self.dir.name)
+		self.assertEqual(self.state(), expected)
+		self.assertEqual(bank.journal.seq, 4)
+		bank.get_account("1").deposit(Currency("$1"))
+		expected = self.state()
+		bank.journal.close()
+		bank.journal = None
+		bank.restore(self.dir.name)
+		self.assertEqual(self.state(), expected)
+
+		bank.checkpoint()
+		bank.journal.close()
+		bank.journal = None
+		bank.restore(self.dir.name)
+		self.assertEqual(self.state(), expected)
+
+class TestMetrics(unittest.TestCase):
+	def test_hooks(self):
+		metrics = bank.metrics = bank.Metrics(io.StringIO())
+		try:
+			a = Account("A", "1", "$100")
+			b = Account("B", "2", "$100")
+			a.withdraw(Currency("$1"))
+			with self.assertRaises(TransactionException):
+				a.withdraw(Currency("$50"))
+			a.apply_penalty()
+			metrics.record_transaction(True)
+			metrics.record_transaction(False)
+			self.assertEqual(metrics.latency["withdraw"].count, 2)
+			b.settle(Currency("$3"), 3)
+			self.assertEqual(metrics.latency["settle"].count, 1)
+			self.assertEqual(b.count_deposit, 3)
+			self.assertEqual(metrics.take_changed(), [a, b])
+			self.assertEqual(metrics.take_changed(), [])
+			b.deposit(Currency("$1"))
+			metrics.report(metrics.take_changed())
+			line = json.loads(metrics.export.getvalue())
+			self.assertEqual(line["changed"][0]["account_id"], "2")
+			self.assertEqual(line["rejection_rate"], 0.5)
+			self.assertEqual(line["penalty_rate"], 0.5)
+		finally:
+			bank.metrics = None
+		a.withdraw(Currency("$1"))
+		self.assertEqual(metrics.latency["withdraw"].count, 2)
+		self.assertEqual(metrics.take_changed(), [])
+
+class TestParallel(unittest.TestCase):
+	def make_ledger(self):
+		ledger = Ledger()
+		for i in range(50):
+			ledger.add(f"Holder {i}", str(i), f"${100 + i}")
+		return ledger
+
+	def test_same_as_serial(self):
+		random.seed(215)
+		rows = []
+		for _ in range(2000):
+			account_id = str(random.randint(0, 49))
+			if random.random() < 0.05:
+				rows.append((account_id, random.randint(-100, 1500), str(random.randint(0, 49))))
+			else:
+				rows.append((account_id, random.randint(-1500, 1000)))
+		expected = self.make_ledger()
+		expected_rejected = expected.apply(rows)
+		with parallel.ParallelLedger(self.make_ledger(), workers=3, chunk_size=128) as engine:
+			actual_rejected = engine.apply(rows)
+			actual = engine.ledger
+		self.assertEqual(list(actual.balance), list(expected.balance))
+		self.assertEqual(list(actual.count_withdraw), list(expected.count_withdraw))
+		self.assertEqual(list(actual.count_deposit), list(expected.count_deposit))
+		self.assertEqual([(i, e.message, e.penalty) for i, e in actual_rejected], [(i, e.message, e.penalty) for i, e in expected_rejected])
+
+	def test_errors(self):
+		expected = self.make_ledger()
+		with parallel.ParallelLedger(self.make_ledger(), workers=3) as engine:
+			# nothing is committed when a row refers to an unknown account, even rows before it
+			with self.assertRaises(KeyError):
+				engine.apply([("1", 100), ("2", -5), ("3", 7, "nobody")])
+			with self.assertRaises(ValueError):
+				engine.apply([("1", 100), ("2", "lots")])
+			engine.apply([("1", 100)])
+			expected.apply([("1", 100)])
+			self.assertEqual(list(engine.ledger.balance), list(expected.balance))
+
+	def test_file(self):
+		random.seed(216)
+		rows = [(str(random.randint(0, 49)), random.randint(-1500, 1000)) for _ in range(3000)]
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "transactions.csv")
+			with open(path, "w", newline="") as f:
+				writer = csv.writer(f)
+				writer.writerow(["account_id", "amount"])
+				writer.writerows((account_id, str(Currency(amount))) for account_id, amount in rows)
+			expected = self.make_ledger()
+			expected_rejected = expected.apply(rows)
+			with parallel.ParallelLedger(self.make_ledger(), workers=3, chunk_bytes=1000) as engine:
+				actual_rejected = engine.apply_file(path)
+				actual = engine.ledger
+		self.assertEqual(list(actual.balance), list(expected.balance))
+		self.assertEqual(list(actual.count_withdraw), list(expected.count_withdraw))
+		self.assertEqual([(i, e.message) for i, e in actual_rejected], [(i, e.message) for i, e in expected_rejected])
+
+	def test_file_checked_first(self):
+		with tempfile.TemporaryDirectory() as d:
+			path = os.path.join(d, "transactions.csv")
+			with open(path, "w") as f:
+				f.writelines(f"{i % 50},$1\n" for i in range(2000))
+				f.write("nobody,$1\n")
+			with parallel.ParallelLedger(self.make_ledger(), workers=2, chunk_bytes=500) as engine:
+				with self.assertRaises(KeyError):
+					engine.apply_file(path)
+				self.assertEqual(list(engine.ledger.balance), list(self.make_ledger().balance))
+				# without the check, the windows before the one with the bad row are applied
+				with self.assertRaises(KeyError):
+					engine.apply_file(path, validate=False)
+				self.assertTrue(0 < sum(engine.ledger.count_deposit) < 2000)
 
 if __name__ == "__main__":
 	unittest.main()
@@ -1,53 +1,315 @@
+from array import array
+from typing import Callable, Iterable, Iterator, Optional, Union
+
+class Catalog(object):
+	"""Interns item names to small integer ids, shared by every inventory."""
+	def __init__(self) -> None:
+		self.ids: dict[str, int] = {}
+		self.names: list[str] = []
+
+	def intern(self, name: str) -> int:
+		item_id = self.ids.get(name)
+		if item_id is None:
+			item_id = self.ids[name] = len(self.names)
+			self.names.append(name)
+		return item_id
+
+	def lookup(self, name: str) -> Optional[int]:
+		return self.ids.get(name)
+
+	def __len__(self) -> int:
+		return len(self.names)
+
+catalog = Catalog()
+
+class ItemIndex(object):
+	"""
+	Which characters hold each item and how many, and which of them are out of it, by catalog id. Until `build` is
+	called, it only keeps track of which characters changed, so a manager that never asks about items doesn't pay for
+	it.
+	"""
+	def __init__(self) -> None:
+		self.built = False
+		self.holders: dict[int, dict["Character", int]] = {}
+		# characters with a count of 0, kept as dicts for their insertion order
+		self.empty: dict[int, dict["Character", None]] = {}
+		# names of the characters changed since the last snapshot, once there is one
+		self.changed: Optional[dict[str, None]] = None
+
+	def build(self, chars: "Iterable[Character]") -> None:
+		"""Index every item of `chars`, and keep indexing the changes made after."""
+		if self.built:
+			return
+		for char in chars:
+			self.fill(char, char.inventory.data)
+		self.built = True
+
+	def set(self, item_id: int, char: "Character", count: int) -> None:
+		if self.changed is not None:
+			self.changed[char.name] = None
+		if not self.built:
+			return
+		self.holders.setdefault(item_id, {})[char] = count
+		if count == 0:
+			self.empty.setdefault(item_id, {})[char] = None
+		else:
+			self.discard_empty(item_id, char)
+
+	def add(self, char: "Character", data: array) -> None:
+		"""Index every item of a character that isn't indexed yet, from its inventory's data."""
+		if self.changed is not None:
+			self.changed[char.name] = None
+		if self.built:
+			self.fill(char, data)
+
+	def fill(self, char: "Character", data: array) -> None:
+		holders = self.holders
+		empty = self.empty
+		for i in range(0, len(data), 2):
+			item_id = ~data[i]
+			count = data[i + 1]
+			holders.setdefault(item_id, {})[char] = count
+			if count == 0:
+				empty.setdefault(item_id, {})[char] = None
+
+	def remove(self, item_id: int, char: "Character") -> None:
+		if self.changed is not None:
+			self.changed[char.name] = None
+		if not self.built:
+			return
+		holders = self.holders.get(item_id)
+		if holders is not None:
+			holders.pop(char, None)
+			if not holders:
+				del self.holders[item_id]
+		self.discard_empty(item_id, char)
+
+	def discard_empty(self, item_id: int, char: "Character") -> None:
+		empty = self.empty.get(item_id)
+		if empty is not None and char in empty:
+			del empty[char]
+			if not empty:
+				del self.empty[item_id]
+
 class Inventory(object):
-	def __init__(self):
-		self.items: dict[str, int] = {}
+	"""
+	Item counts in one array of `[key, count, key, count, ...]`, in the order items were added. Keys are catalog ids
+	stored as `-(id + 1)`, and counts are never negative, so `array.index` on a key can't land on a count. Reading an
+	item that isn't there gives 0 without adding it.
+
+	Small inventories are searched with `array.index`. Once one has more than `INDEXED_ITEMS` items, it keeps a map of
+	item ids to positions too, so lookups don't slow down as it grows.
+
+	Once its character is added to a `Manager`, changes are also made to the manager's `ItemIndex`.
+	"""
+	__slots__ = ("catalog", "data", "index", "owner", "positions")
+	INDEXED_ITEMS = 16
+
+	def __init__(self, items: "dict[str, int]"=None, catalog: Catalog=catalog):
+		self.catalog = catalog
+		self.data = array("q", [x for item, amount in (items or {}).items() for x in (~catalog.intern(item), max(amount, 0))])
+		self.index: Optional[ItemIndex] = None
+		self.owner: Optional["Character"] = None
+		self.positions: Optional[dict[int, int]] = None
+
+	def attach(self, index: Optional[ItemIndex], owner: "Character") -> None:
+		"""Start keeping `index` up to date with this inventory, or stop if `index` is `None`."""
+		data = self.data
+		if self.index is not None:
+			for i in range(0, len(data), 2):
+				self.index.remove(~data[i], self.owner)
+		self.index = index
+		self.owner = owner
+		if index is not None:
+			index.add(owner, data)
+
+	def find(self, key) -> int:
+		item_id = self.catalog.lookup(key)
+		if item_id is None:
+			return -1
+		data = self.data
+		if len(data) > 2 * self.INDEXED_ITEMS:
+			if self.positions is None:
+				self.positions = {~data[i]: i for i in range(0, len(data), 2)}
+			return self.positions.get(item_id, -1)
+		try:
+			return data.index(~item_id)
+		except ValueError:
+			return -1
 
 	def __getitem__(self, key) -> int:
-		if key not in self.items:
-			self.items[key] = 0 # avoid raising KeyError
-		return self.items[key]
+		i = self.find(key)
+		return self.data[i + 1] if i >= 0 else 0
 
 	def __setitem__(self, key, value) -> None:
 		if value < 0:
 			value = 0
-		self.items[key] = value
+		i = self.find(key)
+		if i >= 0:
+			self.data[i + 1] = value
+		else:
+			i = len(self.data)
+			item_id = self.catalog.intern(key)
+			self.data.extend((~item_id, value))
+			if self.positions is not None:
+				self.positions[item_id] = i
+		if self.index is not None:
+			self.index.set(~self.data[i], self.owner, value)
 
 	def __delitem__(self, key) -> None:
-		del self.items[key]
+		i = self.find(key)
+		if i < 0:
+			raise KeyError(key)
+		if self.index is not None:
+			self.index.remove(~self.data[i], self.owner)
+		del self.data[i:i + 2]
+		# the items after it have moved, so the map is rebuilt when it's next needed
+		self.positions = None
 
 	def __contains__(self, key) -> bool:
-		return key in self.items
+		return self.find(key) >= 0
 
-	def __iter__(self) -> "tuple[str, int]":
-		for i in self.items.items():
-			yield i
+	def __len__(self) -> int:
+		return len(self.data) // 2
+
+	def __iter__(self) -> "Iterator[tuple[str, int]]":
+		names = self.catalog.names
+		data = self.data
+		for i in range(0, len(data), 2):
+			yield names[~data[i]], data[i + 1]
 
 
 class Character(object):
-	def __init__(self, name: str, items: "dict[str, int]"=None) -> None:
+	__slots__ = ("name", "inventory")
+
+	def __init__(self, name: str, items: "dict[str, int]"=None, catalog: Catalog=catalog) -> None:
 		self.name = name
-		self.inventory: Inventory = Inventory()
-		if items:
-			for item, amount in items.items():
-				self.inventory[item] = amount
+		self.inventory: Inventory = Inventory(items, catalog)
 
 	def give_item(self, name, amount):
-		self.inventory[name] += amount
-		if self.inventory[name] == 0:
+		count = max(self.inventory[name] + amount, 0)
+		self.inventory[name] = count
+		if count == 0:
 			print(f"{self.name} is all out of {name}")
 
 	def take_item(self, name, amount):
-		self.inventory[name] -= amount
-		if self.inventory[name] == 0:
+		count = max(self.inventory[name] - amount, 0)
+		self.inventory[name] = count
+		if count == 0:
 			print(f"{self.name} is all out of {name}")
 
-class Manager(object):
+class TradeError(Exception):
+	def __init__(self, char: Character, item: str, have: int, need: int) -> None:
+		super().__init__(f"{char.name} has {have} {item}, needs {need}")
+		self.char = char
+		self.item = item
+		self.have = have
+		self.need = need
+
+class Batch(object):
+	"""Item changes to apply together with `Manager.apply`, as `(character name, item, change)`."""
 	def __init__(self) -> None:
+		self.changes: list[tuple[str, str, int]] = []
+
+	def give(self, name: str, item: str, amount: int) -> "Batch":
+		self.changes.append((name, item, amount))
+		return self
+
+	def take(self, name: str, item: str, amount: int) -> "Batch":
+		self.changes.append((name, item, -amount))
+		return self
+
+	def transfer(self, source: str, dest: str, item: str, amount: int) -> "Batch":
+		return self.take(source, item, amount).give(dest, item, amount)
+
+	def trade(self, a: str, b: str, a_gives: "dict[str, int]", b_gives: "dict[str, int]") -> "Batch":
+		for item, amount in a_gives.items():
+			self.transfer(a, b, item, amount)
+		for item, amount in b_gives.items():
+			self.transfer(b, a, item, amount)
+		return self
+
+	def __iter__(self) -> "Iterator[tuple[str, str, int]]":
+		return iter(self.changes)
+
+	def __len__(self) -> int:
+		return len(self.changes)
+
+class Manager(object):
+	def __init__(self, catalog: Catalog=catalog) -> None:
 		self.characters: dict[str, Character] = {}
+		self.catalog = catalog
+		self.index = ItemIndex()
+		# sequence number of the last snapshot saved or loaded
+		self.snapshot_seq = 0
+		# called with every `(character, item)` that a batch left at 0
+		self.on_out_of_stock: Optional[Callable[[list[tuple[Character, str]]], None]] = None
 
 	def add_character(self, char: Character):
 		assert len(char.name) > 0
+		assert char.inventory.catalog is self.catalog
+		replaced = self.characters.get(char.name)
+		if replaced is not None and replaced is not char:
+			replaced.inventory.attach(None, replaced)
 		self.characters[char.name] = char
+		char.inventory.attach(self.index, char)
+
+	def apply(self, changes: "Union[Batch, Iterable[tuple[str, str, int]]]", strict: bool=True) -> "list[tuple[Character, str]]":
+		"""
+		Apply `(character name, item, change)` changes all at once. Changes to the same item of the same character are
+		added up first. Everything is checked before anything is changed: an unknown character raises `KeyError`, and
+		with `strict`, so does taking more than a character has, as a `TradeError`. Without `strict`, counts are
+		clamped to 0 like `Character.take_item` does.
+
+		Returns the `(character, item)` pairs that ended up at 0, which are also passed to `on_out_of_stock`.
+		"""
+		net: dict[tuple[str, str], int] = {}
+		for name, item, amount in changes:
+			key = (name, item)
+			net[key] = net.get(key, 0) + amount
+
+		plan = []
+		characters = self.characters
+		for (name, item), amount in net.items():
+			if amount == 0:
+				continue
+			char = characters[name]
+			have = char.inventory[item]
+			count = have + amount
+			if count < 0:
+				if strict:
+					raise TradeError(char, item, have, -amount)
+				count = 0
+			plan.append((char, item, count))
+
+		out_of_stock = []
+		for char, item, count in plan:
+			char.inventory[item] = count
+			if count == 0:
+				out_of_stock.append((char, item))
+		if out_of_stock and self.on_out_of_stock is not None:
+			self.on_out_of_stock(out_of_stock)
+		return out_of_stock
+
+	def indexed(self) -> ItemIndex:
+		"""The item index, built from every character the first time it's needed."""
+		self.index.build(self.characters.values())
+		return self.index
+
+	def holders(self, item: str) -> "dict[Character, int]":
+		"""Every character that has `item` in their inventory, with how many they have."""
+		return dict(self.indexed().holders.get(self.catalog.lookup(item), {}))
+
+	def out_of(self, item: str) -> "list[Character]":
+		"""Characters that have run out of `item`."""
+		return list(self.indexed().empty.get(self.catalog.lookup(item), {}))
+
+	def out_of_stock(self) -> "Iterator[tuple[Character, str]]":
+		"""Yield `(character, item)` for every item a character has run out of."""
+		names = self.catalog.names
+		for item_id, chars in self.indexed().empty.items():
+			for char in chars:
+				yield char, names[item_id]
 
 	def __iadd__(self, other) -> "Manager":
 		if isinstance(other, list):
@@ -95,7 +357,5 @@ if __name__ == "__main__":
 
 	dump(manager)
 
-	for char in manager:
-		for item, amount in char.inventory:
-			if amount == 0:
-				print(f"{char.name} is all out of {item}.")
+	for char, item in manager.out_of_stock():
+		print(f"{char.name} is all out of {item}.")
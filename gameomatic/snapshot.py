@@ -0,0 +1,321 @@
+"""
+Binary snapshots of a `Manager`'s characters and inventories.
+
+A snapshot has the item names it uses as an interned table, then every character's inventory packed into one int64
+array in the same `[~item id, count, ...]` layout that `Inventory` keeps in memory, so loading an inventory is a
+single copy. Character names are stored with an order sorted by name, so a character can be looked up in the mapped
+file without reading the others.
+
+An incremental snapshot has only the characters changed since the snapshot before it. Load a full snapshot and the
+incremental ones after it, in order, to get the latest state back.
+"""
+
+import os
+import sys
+import mmap
+import struct
+from array import array
+from collections import namedtuple
+from typing import Iterable, Iterator, Optional
+
+from gameomatic import Catalog, Character, Manager, catalog
+
+MAGIC = b"GAMESNP1"
+# the arrays are written as they are in memory, so a snapshot notes which end of an int comes first
+BYTE_ORDER = b"<" if sys.byteorder == "little" else b">"
+KIND_FULL = 0
+KIND_INCREMENTAL = 1
+# magic, byte order, then the fields of `Header`
+HEADER = struct.Struct("<8sc7xQQQQQQ")
+# `base_seq` is the sequence number of the snapshot an incremental one follows, and `data_count` the length of the
+# inventory array
+Header = namedtuple("Header", "kind seq base_seq item_count count data_count")
+
+def read_header(path: str, buffer) -> Header:
+	magic, byte_order, *fields = HEADER.unpack_from(buffer, 0)
+	if magic != MAGIC:
+		raise ValueError(f"{path}: not a gameomatic snapshot")
+	if byte_order != BYTE_ORDER:
+		raise ValueError(f"{path}: saved with {'little' if byte_order == b'<' else 'big'} endian ints, which this machine can't map")
+	return Header(*fields)
+
+class Snapshot:
+	"""
+	An open snapshot. Its arrays are views of the mapped file, so opening one only reads the header, and `character`
+	copies a single inventory out of it.
+	"""
+
+	def __init__(self, path: str):
+		with open(path, "rb") as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			header = read_header(path, self.map)
+		except ValueError:
+			self.map.close()
+			raise
+		self.kind, self.seq, self.base_seq, self.item_count, self.count = header[:5]
+		self.views: "list[memoryview]" = []
+		self.offset = HEADER.size
+		self.item_offsets = self.take(8 * (self.item_count + 1), "Q")
+		self.name_offsets = self.take(8 * (self.count + 1), "Q")
+		self.inventory_offsets = self.take(8 * (self.count + 1), "Q")
+		# positions of the characters, sorted by name
+		self.order = self.take(8 * self.count, "Q")
+		self.data = self.take(8 * header.data_count)
+		self.item_names = self.take(self.item_offsets[-1])
+		self.names = self.take(self.name_offsets[-1])
+
+	def take(self, size: int, typecode: Optional[str]=None) -> memoryview:
+		"""The next `size` bytes of the file, as a view of `typecode` items if one is given."""
+		view = memoryview(self.map)[self.offset:self.offset + size]
+		self.views.append(view)
+		self.offset += size
+		return view.cast(typecode) if typecode else view
+
+	@property
+	def incremental(self) -> bool:
+		return self.kind == KIND_INCREMENTAL
+
+	def items(self) -> "list[str]":
+		offsets = self.item_offsets
+		return [bytes(self.item_names[offsets[i]:offsets[i + 1]]).decode() for i in range(self.item_count)]
+
+	def raw_name(self, i: int) -> bytes:
+		return bytes(self.names[self.name_offsets[i]:self.name_offsets[i + 1]])
+
+	def name(self, i: int) -> str:
+		return self.raw_name(i).decode()
+
+	def find(self, name: str) -> Optional[int]:
+		"""Position of the character called `name`, found by binary search, or `None` if it isn't in the snapshot."""
+		key = name.encode()
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.raw_name(self.order[mid]) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < self.count and self.raw_name(self.order[lo]) == key:
+			return self.order[lo]
+		return None
+
+	def remap(self, catalog: Catalog) -> "Optional[list[int]]":
+		"""Ids in `catalog` of the snapshot's items, or `None` if they're the same ids already."""
+		ids = [catalog.intern(item) for item in self.items()]
+		if all(item_id == i for i, item_id in enumerate(ids)):
+			return None
+		return ids
+
+	def character(self, i: int, catalog: Catalog=catalog, remap: "Optional[list[int]]"=None) -> Character:
+		"""Read the character at position `i`. `remap` is from `Snapshot.remap(catalog)`."""
+		char = Character(self.name(i), catalog=catalog)
+		data = char.inventory.data
+		data.frombytes(self.data[8 * self.inventory_offsets[i]:8 * self.inventory_offsets[i + 1]])
+		if remap is not None:
+			for j in range(0, len(data), 2):
+				data[j] = ~remap[~data[j]]
+		return char
+
+	def __len__(self) -> int:
+		return self.count
+
+	def close(self):
+		for view in (self.item_offsets, self.name_offsets, self.inventory_offsets, self.order, *self.views):
+			view.release()
+		self.map.close()
+
+def save(manager: Manager, path: str, incremental: bool=False) -> int:
+	"""
+	Write the characters of `manager` as a snapshot, or with `incremental`, only the ones changed since the last
+	snapshot it saved or loaded. Returns the snapshot's sequence number.
+	"""
+	if incremental:
+		if not manager.snapshot_seq:
+			raise ValueError("an incremental snapshot needs a full one before it")
+		characters = manager.characters
+		chars = [characters[name] for name in manager.index.changed if name in characters]
+	else:
+		chars = list(manager)
+	names = [char.name.encode() for char in chars]
+	name_offsets = array("Q", [0])
+	inventory_offsets = array("Q", [0])
+	blob = bytearray()
+	data = array("q")
+	for name, char in zip(names, chars):
+		blob += name
+		name_offsets.append(len(blob))
+		data.extend(char.inventory.data)
+		inventory_offsets.append(len(data))
+	order = array("Q", sorted(range(len(names)), key=names.__getitem__))
+	item_offsets = array("Q", [0])
+	item_names = bytearray()
+	for item in manager.catalog.names:
+		item_names += item.encode()
+		item_offsets.append(len(item_names))
+
+	seq = manager.snapshot_seq + 1
+	kind = KIND_INCREMENTAL if incremental else KIND_FULL
+	base_seq = manager.snapshot_seq if incremental else 0
+	header = HEADER.pack(MAGIC, BYTE_ORDER, kind, seq, base_seq, len(manager.catalog), len(chars), len(data))
+	replace_file(path, [header, item_offsets, name_offsets, inventory_offsets, order, data, item_names, blob])
+	manager.snapshot_seq = seq
+	manager.index.changed = {}
+	return seq
+
+def replace_file(path: str, parts: list) -> None:
+	"""
+	Write `parts` next to `path` and only then rename them over it, so `path` never holds half a snapshot, even if
+	the game is killed partway through a save.
+	"""
+	partial = path + ".partial"
+	with open(partial, "wb") as f:
+		for part in parts:
+			f.write(part)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(partial, path)
+
+def open_snapshots(paths: "Iterable[str]") -> "list[Snapshot]":
+	"""Open a full snapshot and the incremental ones that follow it, checking that they're in order."""
+	snapshots = []
+	try:
+		for path in paths:
+			snapshots.append(Snapshot(path))
+			if len(snapshots) == 1 and snapshots[0].incremental:
+				raise ValueError(f"{path} is incremental, but the first snapshot must be a full one")
+			if len(snapshots) > 1 and (not snapshots[-1].incremental or snapshots[-1].base_seq != snapshots[-2].seq):
+				raise ValueError(f"{path} doesn't follow snapshot {snapshots[-2].seq}")
+		if not snapshots:
+			raise ValueError("no snapshots to open")
+	except ValueError:
+		for snapshot in snapshots:
+			snapshot.close()
+		raise
+	return snapshots
+
+def iter_characters(snapshots: "list[Snapshot]", catalog: Catalog=catalog) -> "Iterator[Character]":
+	"""
+	Read the latest version of every character in `snapshots`, in the order they were first saved. A character in a
+	later snapshot replaces the same character in an earlier one.
+	"""
+	base, *later = snapshots
+	base_remap = base.remap(catalog)
+	# the latest version of every character in an incremental snapshot. There are few of them, so they're all read.
+	newer: "dict[str, Character]" = {}
+	for snapshot in later:
+		remap = snapshot.remap(catalog)
+		for i in range(len(snapshot)):
+			char = snapshot.character(i, catalog, remap)
+			newer[char.name] = char
+	for i in range(len(base)):
+		if newer:
+			char = newer.pop(base.name(i), None)
+			if char is not None:
+				yield char
+				continue
+		yield base.character(i, catalog, base_remap)
+	yield from newer.values()
+
+def load(*paths: str, catalog: Catalog=catalog) -> Manager:
+	"""Read a full snapshot and the incremental ones after it into a new `Manager`."""
+	snapshots = open_snapshots(paths)
+	manager = Manager(catalog)
+	try:
+		for char in iter_characters(snapshots, catalog):
+			manager.add_character(char)
+	finally:
+		for snapshot in snapshots:
+			snapshot.close()
+	manager.snapshot_seq = snapshots[-1].seq
+	manager.index.changed = {}
+	return manager
+
+class LazyManager(Manager):
+	"""
+	A `Manager` backed by mapped snapshots. A character is only read when it's first looked up, so opening a world is
+	quick however many characters it has. Iterating, or asking about who holds an item, reads every character.
+	"""
+
+	def __init__(self, *paths: str, catalog: Catalog=catalog) -> None:
+		super().__init__(catalog)
+		self.snapshots = open_snapshots(paths)
+		self.remaps = [snapshot.remap(catalog) for snapshot in self.snapshots]
+		self.snapshot_seq = self.snapshots[-1].seq
+		self.index.changed = {}
+		self.loaded = False
+
+	def read(self, name: str) -> Optional[Character]:
+		for snapshot, remap in zip(reversed(self.snapshots), reversed(self.remaps)):
+			i = snapshot.find(name)
+			if i is not None:
+				return snapshot.character(i, self.catalog, remap)
+		return None
+
+	def add_read(self, char: Character) -> None:
+		"""Add a character as read from the snapshots, which doesn't count as a change."""
+		self.characters[char.name] = char
+		char.inventory.attach(self.index, char)
+		self.index.changed.pop(char.name, None)
+
+	def load_all(self) -> None:
+		"""Read every character that hasn't been read yet."""
+		if self.loaded:
+			return
+		characters = self.characters
+		self.characters = {}
+		for char in iter_characters(self.snapshots, self.catalog):
+			if char.name in characters:
+				self.characters[char.name] = characters.pop(char.name)
+			else:
+				self.add_read(char)
+		# characters added since opening go after the saved ones
+		self.characters.update(characters)
+		self.loaded = True
+
+	def add_character(self, char: Character):
+		if not self.loaded and char.name not in self.characters:
+			# read the saved version first, so it's detached from the index when it's replaced
+			saved = self.read(char.name)
+			if saved is not None:
+				self.add_read(saved)
+		super().add_character(char)
+
+	def apply(self, changes, strict: bool=True) -> "list[tuple[Character, str]]":
+		changes = list(changes)
+		for name, _, _ in changes:
+			self[name]
+		return super().apply(changes, strict)
+
+	def holders(self, item: str) -> "dict[Character, int]":
+		self.load_all()
+		return super().holders(item)
+
+	def out_of(self, item: str) -> "list[Character]":
+		self.load_all()
+		return super().out_of(item)
+
+	def out_of_stock(self) -> "Iterator[tuple[Character, str]]":
+		self.load_all()
+		return super().out_of_stock()
+
+	def __iter__(self):
+		self.load_all()
+		return super().__iter__()
+
+	def __getitem__(self, key):
+		char = self.characters.get(key)
+		if char is None and not self.loaded:
+			char = self.read(key)
+			if char is not None:
+				self.add_read(char)
+		if char is None:
+			raise KeyError(key)
+		return char
+
+	def close(self):
+		"""Read every character and unmap the snapshots."""
+		self.load_all()
+		for snapshot in self.snapshots:
+			snapshot.close()
+		self.snapshots = []
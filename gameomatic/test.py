@@ -1,5 +1,12 @@
+import io
+import os
 import unittest
 import random
+import tempfile
+import contextlib
+
+from gameomatic import Batch, Catalog, Character, Inventory, Manager, TradeError
+import snapshot
 
 class TestRNG(unittest.TestCase):
 	def test_random_is_uniform(self):
@@ -11,5 +18,228 @@ class TestRNG(unittest.TestCase):
 				self.assertAlmostEqual(i, j, delta=0.00681)
 		self.assertAlmostEqual(sum(percentages.values()), 1, places=10) # accounting for floating point rounding errors
 
+class TestInventory(unittest.TestCase):
+	def test_missing_items_not_added(self):
+		inventory = Inventory({"food": 1})
+		self.assertEqual(inventory["kiwi"], 0)
+		self.assertEqual(inventory["never heard of it"], 0)
+		self.assertNotIn("kiwi", inventory)
+		self.assertEqual(len(inventory), 1)
+		self.assertEqual(len(inventory.data), 2)
+
+	def test_mapping(self):
+		inventory = Inventory({"a": 1, "b": -5})
+		inventory["c"] = 3
+		inventory["a"] -= 10
+		self.assertEqual(list(inventory), [("a", 0), ("b", 0), ("c", 3)])
+		del inventory["b"]
+		self.assertEqual(list(inventory), [("a", 0), ("c", 3)])
+		with self.assertRaises(KeyError):
+			del inventory["b"]
+		# a count equal to an item's key doesn't get mistaken for it
+		inventory["c"] = 2 ** 62
+		self.assertEqual(inventory["c"], 2 ** 62)
+
+	def test_shared_catalog(self):
+		catalog = Catalog()
+		x = Inventory({"sword": 1, "shield": 2}, catalog)
+		y = Inventory({"shield": 5}, catalog)
+		self.assertEqual(len(catalog), 2)
+		self.assertEqual(x.data[2], y.data[0])
+
+	def test_large(self):
+		inventory = Inventory({f"item{i}": i for i in range(100)})
+		self.assertEqual(inventory["item70"], 70)
+		self.assertIsNotNone(inventory.positions)
+		inventory["new"] = 7
+		del inventory["item10"]
+		inventory["item99"] += 1
+		self.assertEqual(inventory["new"], 7)
+		self.assertEqual(inventory["item99"], 100)
+		self.assertNotIn("item10", inventory)
+		self.assertEqual(list(inventory)[-2:], [("item99", 100), ("new", 7)])
+		self.assertEqual(dict(inventory), {**{f"item{i}": i for i in range(100) if i != 10}, "item99": 100, "new": 7})
+
+	def test_give_and_take(self):
+		character = Character("Frodo", items={"kiwi": 2})
+		out = io.StringIO()
+		with contextlib.redirect_stdout(out):
+			character.give_item("kiwi", 1)
+			character.take_item("kiwi", 5)
+			character.give_item("ring", 1)
+		self.assertEqual(out.getvalue(), "Frodo is all out of kiwi\n")
+		self.assertEqual(list(character.inventory), [("kiwi", 0), ("ring", 1)])
+
+class TestItemIndex(unittest.TestCase):
+	def setUp(self):
+		self.manager = Manager()
+		self.manager += [
+			Character("a", items={"food": 1, "kiwi": 0}),
+			Character("b", items={"food": 0}),
+		]
+		self.a, self.b = self.manager["a"], self.manager["b"]
+
+	def test_queries(self):
+		self.assertEqual(self.manager.holders("food"), {self.a: 1, self.b: 0})
+		self.assertEqual(self.manager.out_of("food"), [self.b])
+		self.assertEqual(list(self.manager.out_of_stock()), [(self.a, "kiwi"), (self.b, "food")])
+		self.assertEqual(self.manager.holders("unknown"), {})
+		self.assertEqual(self.manager.out_of("unknown"), [])
+
+	def test_updates(self):
+		with contextlib.redirect_stdout(io.StringIO()):
+			self.a.take_item("food", 1)
+			self.b.give_item("food", 3)
+			self.b.give_item("sword", 1)
+		self.assertEqual(self.manager.holders("food"), {self.a: 0, self.b: 3})
+		self.assertEqual(self.manager.out_of("food"), [self.a])
+		self.assertEqual(self.manager.holders("sword"), {self.b: 1})
+		del self.a.inventory["food"]
+		del self.a.inventory["kiwi"]
+		self.assertEqual(self.manager.holders("food"), {self.b: 3})
+		self.assertEqual(list(self.manager.out_of_stock()), [])
+		self.assertNotIn(self.manager.catalog.lookup("kiwi"), self.manager.index.holders)
+
+	def test_built_when_needed(self):
+		self.assertFalse(self.manager.index.built)
+		self.assertEqual(self.manager.index.holders, {})
+		self.manager.apply([("a", "food", -1), ("b", "kiwi", 2)])
+		self.assertEqual(self.manager.out_of("food"), [self.a, self.b])
+		self.assertTrue(self.manager.index.built)
+		self.manager.apply([("a", "food", 1)])
+		self.assertEqual(self.manager.out_of("food"), [self.b])
+
+	def test_replaced_character(self):
+		c = Character("a", items={"kiwi": 2})
+		self.manager += c
+		self.assertEqual(self.manager.holders("food"), {self.b: 0})
+		self.assertEqual(self.manager.holders("kiwi"), {c: 2})
+		# the old character's changes don't reach the index any more
+		self.a.inventory["food"] = 5
+		self.assertEqual(self.manager.holders("food"), {self.b: 0})
+
+	def test_own_catalog(self):
+		other = Catalog()
+		manager = Manager(catalog=other)
+		manager += Character("c", items={"tea": 1}, catalog=other)
+		self.assertEqual(manager.holders("tea"), {manager["c"]: 1})
+		self.assertEqual(other.names, ["tea"])
+		with self.assertRaises(AssertionError):
+			manager += Character("d")
+
+class TestBatch(unittest.TestCase):
+	def setUp(self):
+		self.manager = Manager()
+		self.manager += [
+			Character("a", items={"gold": 10, "kiwi": 2}),
+			Character("b", items={"sword": 1}),
+		]
+		self.events = []
+		self.manager.on_out_of_stock = self.events.append
+
+	def inventories(self) -> "dict[str, list]":
+		return {char.name: list(char.inventory) for char in self.manager}
+
+	def test_trade(self):
+		out = self.manager.apply(Batch().trade("a", "b", {"gold": 10}, {"sword": 1}))
+		self.assertEqual(self.inventories(), {"a": [("gold", 0), ("kiwi", 2), ("sword", 1)], "b": [("sword", 0), ("gold", 10)]})
+		a, b = self.manager["a"], self.manager["b"]
+		self.assertEqual(out, [(a, "gold"), (b, "sword")])
+		# delivered once, for the whole batch
+		self.assertEqual(self.events, [out])
+		self.assertEqual(self.manager.out_of("gold"), [a])
+
+	def test_all_or_nothing(self):
+		before = self.inventories()
+		batch = Batch().give("a", "kiwi", 5).transfer("a", "b", "gold", 11)
+		with self.assertRaises(TradeError) as e:
+			self.manager.apply(batch)
+		self.assertEqual((e.exception.item, e.exception.have, e.exception.need), ("gold", 10, 11))
+		with self.assertRaises(KeyError):
+			self.manager.apply([("a", "kiwi", 1), ("nobody", "kiwi", 1)])
+		self.assertEqual(self.inventories(), before)
+		self.assertEqual(self.events, [])
+
+	def test_net_changes(self):
+		# taking 12 gold is fine when 5 more arrive in the same batch
+		self.manager.apply([("a", "gold", -12), ("a", "gold", 5), ("b", "kiwi", 1), ("b", "kiwi", -1)])
+		self.assertEqual(self.inventories(), {"a": [("gold", 3), ("kiwi", 2)], "b": [("sword", 1)]})
+
+	def test_clamp(self):
+		self.manager.apply([("a", "kiwi", -5)], strict=False)
+		self.assertEqual(self.manager["a"].inventory["kiwi"], 0)
+		self.assertEqual(self.events, [[(self.manager["a"], "kiwi")]])
+
+class TestSnapshot(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.manager = Manager()
+		self.manager += [
+			Character("a", items={"gold": 10, "kiwi": 2}),
+			Character("b", items={"sword": 1, "kiwi": 0}),
+			Character("c"),
+		]
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+	def path(self, name: str) -> str:
+		return os.path.join(self.dir.name, name)
+
+	def inventories(self, manager: Manager) -> "dict[str, list]":
+		return {char.name: list(char.inventory) for char in manager}
+
+	def test_round_trip(self):
+		self.assertEqual(snapshot.save(self.manager, self.path("full")), 1)
+		# a different catalog with the items interned in another order
+		other = Catalog()
+		other.intern("sword")
+		loaded = snapshot.load(self.path("full"), catalog=other)
+		self.assertEqual(self.inventories(loaded), self.inventories(self.manager))
+		self.assertEqual(loaded.out_of("kiwi"), [loaded["b"]])
+		self.assertEqual(loaded.snapshot_seq, 1)
+
+	def test_incremental(self):
+		snapshot.save(self.manager, self.path("full"))
+		self.manager.apply(Batch().transfer("a", "b", "gold", 3))
+		self.manager += Character("d", items={"gold": 1})
+		snapshot.save(self.manager, self.path("1"), incremental=True)
+		self.manager.apply([("c", "kiwi", 4)])
+		# a replaced character isn't kept around until the next snapshot
+		self.manager += Character("d", items={"gold": 2})
+		self.assertEqual(list(self.manager.index.changed), ["c", "d"])
+		self.assertEqual(snapshot.save(self.manager, self.path("2"), incremental=True), 3)
+		for name, count in (("1", 3), ("2", 2)):
+			saved = snapshot.Snapshot(self.path(name))
+			self.assertEqual(len(saved), count)
+			saved.close()
+
+		loaded = snapshot.load(self.path("full"), self.path("1"), self.path("2"), catalog=Catalog())
+		self.assertEqual(self.inventories(loaded), self.inventories(self.manager))
+		with self.assertRaises(ValueError):
+			snapshot.load(self.path("full"), self.path("2"), catalog=Catalog())
+		with self.assertRaises(ValueError):
+			snapshot.load(self.path("1"), catalog=Catalog())
+
+	def test_lazy(self):
+		snapshot.save(self.manager, self.path("full"))
+		self.manager.apply([("b", "sword", -1)])
+		snapshot.save(self.manager, self.path("1"), incremental=True)
+		lazy = snapshot.LazyManager(self.path("full"), self.path("1"))
+		self.assertEqual(lazy["b"].inventory["sword"], 0)
+		self.assertEqual(list(lazy.characters), ["b"])
+		with self.assertRaises(KeyError):
+			lazy["nobody"]
+		lazy.apply([("a", "kiwi", -2)])
+		self.assertEqual(list(lazy.characters), ["b", "a"])
+		self.assertEqual(set(lazy.out_of("kiwi")), {lazy["a"], lazy["b"]})
+		self.assertEqual(self.inventories(lazy), {**self.inventories(self.manager), "a": [("gold", 10), ("kiwi", 0)]})
+		# only what changed after opening goes in the next incremental snapshot
+		snapshot.save(lazy, self.path("2"), incremental=True)
+		saved = snapshot.Snapshot(self.path("2"))
+		self.assertEqual([saved.name(i) for i in range(len(saved))], ["a"])
+		saved.close()
+		lazy.close()
+
 if __name__ == "__main__":
 	unittest.main()
@@ -1,9 +1,172 @@
 #!/usr/bin/env python3
+"""
+Generate random rows for the `students` table from McManus_dbSQL.
+
+With `--db`, rows are written straight into a SQLite file with parameterized `executemany`, committed every
+`--transaction-rows` rows. Rows are made in fixed size chunks, each with its own generator seeded from `--seed` and
+the chunk number, so the same seed gives the same rows however many `--processes` make them.
+
+	./generator.py --rows 5000000 --seed 1 --db students.db --processes 4
+
+Without `--db`, the rows are printed as `INSERT` statements instead.
+"""
+
+import sys
+import time
 import random
 import string
+import sqlite3
+import argparse
+import multiprocessing
+from typing import Iterator
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS students (
+	StudID int,
+	FirstName varchar,
+	LastName varchar,
+	Major varchar,
+	Year int
+)"""
+INSERT = "INSERT INTO students (StudID, FirstName, LastName, Major, Year) VALUES (?, ?, ?, ?, ?)"
+ALPHABET = string.ascii_uppercase + string.ascii_lowercase + string.digits
+NUMBERS = range(1, 98233300)
+LENGTHS = range(5, 15)
+CHUNK_ROWS = 50_000
+# tuned for one bulk load into a file that can be thrown away if it fails
+PRAGMAS = {
+	"journal_mode": "OFF",
+	"synchronous": "OFF",
+	"cache_size": "-65536",
+	"temp_store": "MEMORY",
+	"locking_mode": "EXCLUSIVE",
+}
+# pragmas that can be set, with the keywords they take, or `int` for the ones that take a number
+PRAGMA_VALUES = {
+	"journal_mode": {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"},
+	"synchronous": {"OFF", "NORMAL", "FULL", "EXTRA", "0", "1", "2", "3"},
+	"temp_store": {"DEFAULT", "FILE", "MEMORY", "0", "1", "2"},
+	"locking_mode": {"NORMAL", "EXCLUSIVE"},
+	"cache_size": int,
+	"page_size": int,
+	"mmap_size": int,
+	"wal_autocheckpoint": int,
+}
+
+def make_chunk(seed: int, chunk: int, count: int) -> "list[tuple[int, str, str, str, int]]":
+	"""
+	Rows of chunk number `chunk`, which are always the same for the same seed. Every random value of the chunk is drawn
+	at once and the strings are sliced out of one long one, which is much faster than drawing them one at a time.
+	"""
+	rng = random.Random(f"{seed}:{chunk}")
+	numbers = rng.choices(NUMBERS, k=2 * count)
+	lengths = rng.choices(LENGTHS, k=3 * count)
+	text = "".join(rng.choices(ALPHABET, k=sum(lengths)))
+	strings = []
+	end = 0
+	for length in lengths:
+		strings.append(text[end:end + length])
+		end += length
+	return list(zip(numbers[::2], strings[::3], strings[1::3], strings[2::3], numbers[1::2]))
+
+def make_chunk_args(args: "tuple[int, int, int]") -> "list[tuple[int, str, str, str, int]]":
+	return make_chunk(*args)
+
+def chunks(rows: int, seed: int, processes: int=1) -> "Iterator[list[tuple[int, str, str, str, int]]]":
+	"""Yield `rows` rows in chunks, in order, made by `processes` worker processes if there's more than one."""
+	jobs = [(seed, chunk, min(CHUNK_ROWS, rows - start)) for chunk, start in enumerate(range(0, rows, CHUNK_ROWS))]
+	if processes <= 1 or len(jobs) <= 1:
+		for job in jobs:
+			yield make_chunk(*job)
+		return
+	with multiprocessing.Pool(processes) as pool:
+		yield from pool.imap(make_chunk_args, jobs)
+
+def check_pragma(name: str, value: str) -> str:
+	"""
+	The value to set pragma `name` to, as it goes into the `PRAGMA` statement. Values can't be query parameters, so only
+	the pragmas in `PRAGMA_VALUES` are allowed, with one of their keywords or an integer.
+	"""
+	allowed = PRAGMA_VALUES.get(name)
+	if allowed is None:
+		raise ValueError(f"unsupported pragma {name}, expected one of {', '.join(PRAGMA_VALUES)}")
+	if allowed is int:
+		try:
+			return str(int(value))
+		except ValueError:
+			raise ValueError(f"pragma {name} takes an integer, got {value!r}") from None
+	if value.upper() not in allowed:
+		raise ValueError(f"pragma {name} takes one of {', '.join(sorted(allowed))}, got {value!r}")
+	return value.upper()
+
+def connect(path: str, pragmas: "dict[str, str]") -> sqlite3.Connection:
+	checked = {name: check_pragma(name, str(value)) for name, value in pragmas.items()}
+	db = sqlite3.connect(path, isolation_level=None)
+	for name, value in checked.items():
+		db.execute(f"PRAGMA {name}={value}")
+	db.execute(SCHEMA)
+	return db
+
+def load(path: str, rows: int, seed: int, processes: int=1, transaction_rows: int=500_000, pragmas: "dict[str, str]"=PRAGMAS) -> int:
+	"""Insert `rows` rows into the students table of the SQLite file at `path`. Returns how many were inserted."""
+	db = connect(path, pragmas)
+	inserted = 0
+	pending = 0
+	try:
+		db.execute("BEGIN")
+		for chunk in chunks(rows, seed, processes):
+			db.executemany(INSERT, chunk)
+			inserted += len(chunk)
+			pending += len(chunk)
+			if pending >= transaction_rows:
+				db.execute("COMMIT")
+				db.execute("BEGIN")
+				pending = 0
+		db.execute("COMMIT")
+	except BaseException:
+		if db.in_transaction:
+			db.execute("ROLLBACK")
+		raise
+	finally:
+		db.close()
+	return inserted
+
+def quote(value) -> str:
+	if isinstance(value, str):
+		return "'" + value.replace("'", "''") + "'"
+	return str(value)
+
+def print_inserts(rows: int, seed: int):
+	for chunk in chunks(rows, seed):
+		for row in chunk:
+			print(f"INSERT INTO students (StudID, FirstName, LastName, Major, Year) VALUES ({', '.join(quote(value) for value in row)});")
+
+def parse_pragma(s: str) -> "tuple[str, str]":
+	name, sep, value = s.partition("=")
+	if not sep:
+		raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {s}")
+	try:
+		return name, check_pragma(name, value)
+	except ValueError as e:
+		raise argparse.ArgumentTypeError(str(e)) from None
+
+def main(argv: "list[str]"=None):
+	parser = argparse.ArgumentParser(description="Generate random rows for the students table.")
+	parser.add_argument("--rows", type=int, default=5, help="Number of rows to generate.")
+	parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible rows. Random if not given.")
+	parser.add_argument("--db", help="SQLite file to insert the rows into. Without it, INSERT statements are printed.")
+	parser.add_argument("--processes", type=int, default=1, help="Worker processes that generate rows.")
+	parser.add_argument("--transaction-rows", type=int, default=500_000, help="Rows inserted per transaction.")
+	parser.add_argument("--pragma", type=parse_pragma, action="append", default=[], metavar="NAME=VALUE", help=f"SQLite pragma to set, on top of the defaults ({', '.join(f'{k}={v}' for k, v in PRAGMAS.items())}). Can be given more than once.")
+	args = parser.parse_args(argv)
 
-def randstring():
-	return ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase + string.digits) for _ in range(random.randint(5, 14)))
+	seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+	if args.db is None:
+		print_inserts(args.rows, seed)
+		return
+	start = time.perf_counter()
+	inserted = load(args.db, args.rows, seed, args.processes, args.transaction_rows, {**PRAGMAS, **dict(args.pragma)})
+	elapsed = time.perf_counter() - start
+	print(f"inserted {inserted} rows into {args.db} in {elapsed:.1f}s ({inserted / elapsed:.0f} rows/s, seed {seed})", file=sys.stderr)
 
-for _ in range(5):
-	print(f"INSERT INTO students (StudID, FirstName, LastName, Major, Year) VALUES ({random.randint(1, 98233299)}, '{randstring()}', '{randstring()}', '{randstring()}', {random.randint(1, 98233299)});")
\ No newline at end of file
+if __name__ == "__main__":
+	main()
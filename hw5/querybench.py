@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Benchmark a suite of named queries against a SQLite database, and suggest indexes for them.
+
+Every query is timed over `--repeat` runs, fetching all of its rows, and its `EXPLAIN QUERY PLAN` is recorded. Tables
+that a plan scans in full get candidate indexes on the columns the query compares them by. A candidate is only kept
+if the planner actually uses it, and then the whole suite is run again with the kept indexes to measure the speedup.
+
+The database is copied into memory first, so it's never changed and disk caching doesn't skew the timings.
+
+	./querybench.py chinook.db --repeat 50 --json chinook.json
+	./querybench.py chinook.db --queries McManus_dbSQL
+	./querybench.py chinook.db --baseline chinook.json
+
+Queries come from a built-in suite for each known schema (chinook, music, and the students table from generator.py),
+or from a SQL file where each `-- name` comment names the statements after it. Only `SELECT` and `WITH` statements
+are run. Reports are JSON, with a hash of the schema so runs against different schema versions can be told apart.
+"""
+
+import re
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import statistics
+from typing import Optional, TextIO
+
+# (tables the suite needs, {name: query})
+SUITES = [
+	({"tracks", "albums", "artists", "invoices", "invoice_items", "customers", "employees"}, {
+		"sales_support_agents": "SELECT EmployeeId, FirstName, LastName, Title FROM employees WHERE Title='Sales Support Agent'",
+		"albums_by_artists": "SELECT AlbumId, Title FROM albums WHERE ArtistId=2 OR ArtistId=27 OR ArtistId=82",
+		"tracks_by_composer": "SELECT TrackId, Name FROM tracks WHERE Composer='AC/DC'",
+		"long_tracks": "SELECT Name, Milliseconds FROM tracks WHERE Milliseconds > 600000",
+		"customer_by_email": "SELECT CustomerId, FirstName, LastName FROM customers WHERE Email='luisg@embraer.com.br'",
+		"invoices_by_country": "SELECT InvoiceId, InvoiceDate, Total FROM invoices WHERE BillingCountry='Germany' ORDER BY InvoiceDate",
+		"top_artists_by_sales": """
+			SELECT ar.Name, SUM(ii.UnitPrice * ii.Quantity) AS sales
+			FROM invoice_items ii
+			JOIN tracks t ON t.TrackId = ii.TrackId
+			JOIN albums al ON al.AlbumId = t.AlbumId
+			JOIN artists ar ON ar.ArtistId = al.ArtistId
+			GROUP BY ar.ArtistId ORDER BY sales DESC LIMIT 10""",
+		"tracks_of_artist": """
+			SELECT t.Name FROM tracks t
+			JOIN albums al ON al.AlbumId = t.AlbumId
+			JOIN artists ar ON ar.ArtistId = al.ArtistId
+			WHERE ar.Name = 'Iron Maiden'""",
+	}),
+	({"Artist", "Album", "Track", "Genre"}, {
+		"tracks_with_album_and_artist": """
+			SELECT Track.title, Album.title, Artist.name FROM Track
+			JOIN Album ON Track.album_id = Album.id
+			JOIN Artist ON Album.artist_id = Artist.id""",
+		"tracks_by_genre": "SELECT Track.title FROM Track JOIN Genre ON Track.genre_id = Genre.id WHERE Genre.name = 'Metal'",
+		"albums_of_artist": "SELECT title FROM Album WHERE artist_id = 3",
+		"top_rated": "SELECT title, rating FROM Track WHERE rating >= 5 ORDER BY title",
+	}),
+	({"students"}, {
+		"student_by_id": "SELECT * FROM students WHERE StudID = 56225348",
+		"students_by_last_name": "SELECT StudID, FirstName FROM students WHERE LastName = 'qkg8BYnYJ'",
+		"students_in_major_by_year": "SELECT StudID FROM students WHERE Major = 'Q8PMv38' AND Year > 1000",
+		"count_by_major": "SELECT Major, COUNT(*) FROM students GROUP BY Major ORDER BY COUNT(*) DESC LIMIT 10",
+	}),
+]
+
+SQL_KEYWORDS = {"where", "on", "join", "inner", "left", "right", "cross", "outer", "natural", "group", "order", "limit", "using", "union", "having"}
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+TABLE_REF = re.compile(r"\b(?:FROM|JOIN)\s+[\[\"`]?(\w+)[\]\"`]?(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+COLUMN = r"(?:(\w+)\.)?[\[\"`]?(\w+)[\]\"`]?"
+EQUALITY = re.compile(COLUMN + r"\s*(?:==?|\bIN\b|\bIS\b)", re.IGNORECASE)
+# the other side of `a.x = b.y`, matched separately since the first side's match has used up the `=`
+EQUALITY_RIGHT = re.compile(r"==?\s*" + COLUMN, re.IGNORECASE)
+RANGE = re.compile(COLUMN + r"\s*(?:<=?|>=?|\bBETWEEN\b|\bLIKE\b)", re.IGNORECASE)
+# `SCAN t`, or `SCAN TABLE t` before SQLite 3.36, without an index
+FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)\b(?! USING)")
+
+def copy_to_memory(path: str) -> sqlite3.Connection:
+	src = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+	db = sqlite3.connect(":memory:")
+	src.backup(db)
+	src.close()
+	return db
+
+def schema_hash(db: sqlite3.Connection) -> str:
+	"""Hash of every table and index definition, which changes when the schema does."""
+	rows = db.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL ORDER BY sql").fetchall()
+	return hashlib.sha1("\n".join(sql for (sql,) in rows).encode()).hexdigest()
+
+def tables_of(db: sqlite3.Connection) -> "set[str]":
+	return {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+
+def builtin_suite(db: sqlite3.Connection) -> "dict[str, str]":
+	tables = tables_of(db)
+	queries = {}
+	for required, suite in SUITES:
+		if required <= tables:
+			queries.update(suite)
+	return queries
+
+def read_queries(f: TextIO) -> "dict[str, str]":
+	"""
+	Named `SELECT` and `WITH` statements from a SQL file. A `-- name` comment names the statements after it, numbered
+	if there's more than one. Other statements are skipped.
+	"""
+	queries = {}
+	name = "query"
+	count = 0
+	statement = ""
+	for line in f:
+		if not statement.strip() and line.lstrip().startswith("--"):
+			name = line.lstrip()[2:].strip() or name
+			count = 0
+			continue
+		statement += line
+		if not sqlite3.complete_statement(statement):
+			continue
+		sql = statement.strip().rstrip(";").strip()
+		statement = ""
+		if sql.split(None, 1)[0].upper() not in ("SELECT", "WITH"):
+			continue
+		count += 1
+		queries[name if count == 1 else f"{name} #{count}"] = sql
+	return queries
+
+def plan_of(db: sqlite3.Connection, sql: str) -> "list[str]":
+	return [detail for *_, detail in db.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+def table_aliases(sql: str) -> "dict[str, str]":
+	"""The tables `sql` refers to, by every lowercased name or alias it gives them."""
+	aliases = {}
+	for table, alias in TABLE_REF.findall(STRING_LITERAL.sub("?", sql)):
+		aliases[table.lower()] = table
+		if alias and alias.lower() not in SQL_KEYWORDS:
+			aliases[alias.lower()] = table
+	return aliases
+
+def full_scans(plan: "list[str]", sql: str) -> "list[str]":
+	"""Tables that `plan` scans in full, by their names rather than the aliases that `sql`, the planned query, uses."""
+	aliases = table_aliases(sql)
+	scanned = (match.group(1) for match in map(FULL_SCAN.match, plan) if match)
+	return list(dict.fromkeys(aliases.get(name.lower(), name) for name in scanned))
+
+def time_query(db: sqlite3.Connection, sql: str, repeat: int) -> "tuple[int, list[int]]":
+	"""Row count and the time of each run in nanoseconds, after one untimed run to warm up."""
+	rows = len(db.execute(sql).fetchall())
+	samples = []
+	for _ in range(repeat):
+		start = time.perf_counter_ns()
+		db.execute(sql).fetchall()
+		samples.append(time.perf_counter_ns() - start)
+	return rows, samples
+
+def distribution(samples: "list[int]") -> dict:
+	ordered = sorted(samples)
+	us = [ns / 1000 for ns in ordered]
+	return {
+		"runs": len(us),
+		"min_us": us[0],
+		"median_us": statistics.median(us),
+		"mean_us": statistics.fmean(us),
+		"p90_us": us[min(len(us) - 1, int(len(us) * 0.9))],
+		"max_us": us[-1],
+		"stdev_us": statistics.stdev(us) if len(us) > 1 else 0.0,
+		"samples_us": [ns / 1000 for ns in samples],
+	}
+
+def candidate_indexes(db: sqlite3.Connection, sql: str, scanned: "list[str]") -> "dict[str, list[list[str]]]":
+	"""
+	Indexes that might let the query avoid scanning the `scanned` tables, as lists of columns to try in turn for each
+	table: first the columns the table is compared for equality by followed by the first one it's compared by range,
+	then each of those columns alone.
+	"""
+	text = STRING_LITERAL.sub("?", sql)
+	aliases = table_aliases(sql)
+	columns = {}
+	rowids = set()
+	for table in set(aliases.values()):
+		info = db.execute(f'PRAGMA table_info("{table}")').fetchall()
+		columns[table] = {name.lower(): name for _, name, *_ in info}
+		keys = [(name, type) for _, name, type, _, _, pk in info if pk]
+		# an INTEGER PRIMARY KEY is the rowid, which needs no index
+		if len(keys) == 1 and keys[0][1].upper() == "INTEGER":
+			rowids.add((table, keys[0][0]))
+
+	def resolve(qualifier: str, column: str) -> "Optional[tuple[str, str]]":
+		if qualifier:
+			table = aliases.get(qualifier.lower())
+			tables = [table] if table is not None else []
+		else:
+			tables = [table for table in columns if column.lower() in columns[table]]
+		if len(tables) != 1 or column.lower() not in columns[tables[0]]:
+			return None
+		resolved = tables[0], columns[tables[0]][column.lower()]
+		return None if resolved in rowids else resolved
+
+	equal: "dict[str, list[str]]" = {}
+	ranged: "dict[str, list[str]]" = {}
+	for pattern, found in ((EQUALITY, equal), (EQUALITY_RIGHT, equal), (RANGE, ranged)):
+		for match in pattern.finditer(text):
+			resolved = resolve(match.group(1), match.group(2))
+			if resolved is not None and resolved[1] not in found.setdefault(resolved[0], []):
+				found[resolved[0]].append(resolved[1])
+
+	candidates = {}
+	for table in scanned:
+		cols = list(equal.get(table, []))
+		for column in ranged.get(table, []):
+			if column not in cols:
+				cols.append(column)
+				break
+		if cols:
+			candidates[table] = [cols] + [[column] for column in cols] if len(cols) > 1 else [cols]
+	return candidates
+
+def index_sql(table: str, cols: "list[str]") -> "tuple[str, str]":
+	name = f"bench_{table}_{'_'.join(cols)}".lower()
+	quoted = ", ".join(f'"{col}"' for col in cols)
+	return name, f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({quoted})'
+
+def advise(db: sqlite3.Connection, sql: str, plan: "list[str]") -> "list[str]":
+	"""
+	`CREATE INDEX` statements for indexes that the planner uses for `sql`. Candidates are tried one at a time, and the
+	first one used for each table is kept.
+	"""
+	useful = []
+	for table, tries in candidate_indexes(db, sql, full_scans(plan, sql)).items():
+		for cols in tries:
+			name, create = index_sql(table, cols)
+			db.execute(create)
+			try:
+				used = any(name in detail for detail in plan_of(db, sql))
+			finally:
+				db.execute(f'DROP INDEX "{name}"')
+			if used:
+				useful.append(create)
+				break
+	return useful
+
+def run_suite(db: sqlite3.Connection, queries: "dict[str, str]", repeat: int) -> "dict[str, dict]":
+	results = {}
+	for name, sql in queries.items():
+		plan = plan_of(db, sql)
+		rows, samples = time_query(db, sql, repeat)
+		results[name] = {"sql": sql, "rows": rows, "plan": plan, "full_scans": full_scans(plan, sql), "timing": distribution(samples)}
+	return results
+
+def benchmark(path: str, queries: "Optional[dict[str, str]]"=None, repeat: int=20, suggest: bool=True) -> dict:
+	"""
+	Run `queries`, or the built-in suite for the database's schema, and return the report. With `suggest`, indexes are
+	suggested for queries with full scans, and the suite is run again with them.
+	"""
+	db = copy_to_memory(path)
+	try:
+		if queries is None:
+			queries = builtin_suite(db)
+		report = {
+			"database": path,
+			"schema": schema_hash(db),
+			"sqlite_version": sqlite3.sqlite_version,
+			"repeat": repeat,
+			"queries": run_suite(db, queries, repeat),
+		}
+		if not suggest:
+			return report
+		indexes = []
+		for result in report["queries"].values():
+			result["suggested_indexes"] = advise(db, result["sql"], result["plan"]) if result["full_scans"] else []
+			indexes.extend(create for create in result["suggested_indexes"] if create not in indexes)
+		report["suggested_indexes"] = indexes
+		if not indexes:
+			return report
+		for create in indexes:
+			db.execute(create)
+		report["indexed_schema"] = schema_hash(db)
+		for name, indexed in run_suite(db, queries, repeat).items():
+			result = report["queries"][name]
+			result["indexed"] = {"plan": indexed["plan"], "full_scans": indexed["full_scans"], "timing": indexed["timing"]}
+			result["speedup"] = result["timing"]["median_us"] / max(indexed["timing"]["median_us"], 1e-3)
+		return report
+	finally:
+		db.close()
+
+def print_report(report: dict, baseline: "Optional[dict]"=None, f: TextIO=sys.stdout):
+	"""Print a readable summary, with the change in median time since `baseline` if there is one."""
+	print(f"{report['database']} (schema {report['schema'][:8]}, SQLite {report['sqlite_version']}), {report['repeat']} runs per query:", file=f)
+	for name, result in report["queries"].items():
+		timing = result["timing"]
+		line = f"\t{name.ljust(30)} {result['rows']:>7} rows  median {timing['median_us']:>9.1f} us  p90 {timing['p90_us']:>9.1f} us"
+		if "speedup" in result:
+			line += f"  indexed {result['indexed']['timing']['median_us']:>9.1f} us ({result['speedup']:.1f}x)"
+		if baseline is not None and name in baseline["queries"]:
+			before = baseline["queries"][name]["timing"]["median_us"]
+			line += f"  was {before:.1f} us ({(timing['median_us'] - before) / before * 100:+.0f}%)"
+		print(line, file=f)
+		if result["full_scans"]:
+			print(f"\t\tfull scan of {', '.join(result['full_scans'])}", file=f)
+		for create in result.get("suggested_indexes", []):
+			print(f"\t\tsuggest {create}", file=f)
+	if baseline is not None and baseline["schema"] != report["schema"]:
+		print(f"\tbaseline was run against a different schema ({baseline['schema'][:8]})", file=f)
+
+def main(argv: "list[str]"=None):
+	parser = argparse.ArgumentParser(description="Benchmark named queries against a SQLite database and suggest indexes.")
+	parser.add_argument("database", help="SQLite file to benchmark. It's copied into memory and never changed.")
+	parser.add_argument("--queries", help="SQL file of queries, each named by a -- comment before it. Defaults to the built-in suite for the schema.")
+	parser.add_argument("--repeat", type=int, default=20, help="Timed runs of each query.")
+	parser.add_argument("--no-suggest", action="store_true", help="Don't suggest indexes or run the suite again with them.")
+	parser.add_argument("--json", help="Write the report as JSON to this file.")
+	parser.add_argument("--baseline", help="Earlier JSON report to compare median times against.")
+	args = parser.parse_args(argv)
+
+	queries = None
+	if args.queries:
+		with open(args.queries) as f:
+			queries = read_queries(f)
+	report = benchmark(args.database, queries, args.repeat, not args.no_suggest)
+	if not report["queries"]:
+		parser.error("no queries to run: the schema has no built-in suite, so give some with --queries")
+	baseline = None
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+	print_report(report, baseline)
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump(report, f, indent="\t")
+
+if __name__ == "__main__":
+	main()
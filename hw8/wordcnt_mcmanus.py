@@ -1,8 +1,135 @@
-def word_count():
-	with open("alice.txt", "r") as f:
-		count = sum([len(line.split()) for line in f.readlines()])
-	print(f"The file alice.txt has about {count} words")
+#!/usr/bin/env python3
+"""
+Count the words in a file, a chunk at a time, over a pool of processes.
+
+A word is a run of bytes other than ASCII whitespace, like `bytes.split()` sees it. The file is mapped into memory and
+split into fixed size chunks. Each chunk counts the words that start in it, so a word that spans two chunks is counted
+once, by the chunk it starts in. Only a chunk per process is in memory at a time, however big the file is.
+
+	./wordcnt_mcmanus.py corpus.txt --processes 8 --top 20 --normalize
+
+With `--top`, per-word frequency tables are made too, and merged across the processes. A chunk then only counts the
+words that are wholly inside it, and sends back the pieces of the words cut off at its edges, which are joined up in
+file order.
+"""
+
+import os
+import mmap
+import string
+import argparse
+import multiprocessing
+from collections import Counter
+from typing import Optional
+
+CHUNK_SIZE = 4 * 1024 * 1024
+WHITESPACE = b" \t\n\r\x0b\x0c"
+# maps whitespace to a space and everything else to x, so a word starts wherever " x" is
+WORD_STARTS = bytes(b" "[0] if byte in WHITESPACE else b"x"[0] for byte in range(256))
+PUNCTUATION = string.punctuation.encode()
+
+def chunk_ranges(size: int, chunk_size: int=CHUNK_SIZE) -> "list[tuple[int, int]]":
+	return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+def tally(words: "list[bytes]", normalize: bool=False) -> Counter:
+	"""
+	How often each word comes up. `normalize` lowercases words and strips the punctuation around them first, and
+	drops the ones that were only punctuation.
+	"""
+	if not normalize:
+		return Counter(words)
+	words = [word.strip(PUNCTUATION).lower() for word in words]
+	return Counter(word for word in words if word)
+
+def count_chunk(path: str, start: int, end: int, frequencies: bool=False, normalize: bool=False) -> "tuple[int, Optional[Counter], Optional[tuple[bytes, Optional[bytes]]]]":
+	"""
+	Count the words that start between `start` and `end`. With `frequencies`, only the words wholly inside the chunk
+	are counted, along with how often each comes up, and the chunk's edges are returned too: the bytes before its
+	first whitespace and the ones after its last, or the whole chunk and `None` if it has no whitespace at all.
+	"""
+	with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+		if not frequencies:
+			# the word the chunk starts in the middle of belongs to the chunk before
+			continues = start > 0 and m[start - 1] not in WHITESPACE and m[start] not in WHITESPACE
+			marked = m[start:end].translate(WORD_STARTS)
+			return marked.count(b" x") + (marked[:1] == b"x") - continues, None, None
+		piece = m[start:end]
+
+	words = piece.split()
+	if len(words) == 1 and len(words[0]) == len(piece):
+		return 0, Counter(), (piece, None)
+	head = words.pop(0) if words and piece[0] not in WHITESPACE else b""
+	tail = words.pop() if words and piece[-1] not in WHITESPACE else b""
+	return len(words), tally(words, normalize), (head, tail)
+
+def count_chunk_args(args: tuple) -> "tuple[int, Optional[Counter], Optional[tuple[bytes, Optional[bytes]]]]":
+	return count_chunk(*args)
+
+def count_words(path: str, processes: Optional[int]=None, chunk_size: int=CHUNK_SIZE, frequencies: bool=False, normalize: bool=False) -> "tuple[int, Optional[Counter]]":
+	"""
+	Count the words in the file at `path` over `processes` processes, one per CPU by default. With `frequencies`, also
+	returns how often each word comes up, as bytes, merged from every chunk.
+	"""
+	# with frequencies, the words cut across chunk edges are joined up here, in file order
+	edge_words = []
+	# pieces of the word the last chunk ended in the middle of
+	carry: "list[bytes]" = []
+	jobs = [(path, start, end, frequencies, normalize) for start, end in chunk_ranges(os.path.getsize(path), chunk_size)]
+	total = 0
+	table = Counter() if frequencies else None
+	processes = processes or os.cpu_count() or 1
+	if processes == 1 or len(jobs) <= 1:
+		results = map(count_chunk_args, jobs)
+		pool = None
+	else:
+		pool = multiprocessing.Pool(min(processes, len(jobs)))
+		results = pool.imap(count_chunk_args, jobs)
+	try:
+		for count, chunk_table, edges in results:
+			total += count
+			if chunk_table is None:
+				continue
+			table.update(chunk_table)
+			head, tail = edges
+			carry.append(head)
+			if tail is not None:
+				edge_words.append(b"".join(carry))
+				carry = [tail]
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	edge_words.append(b"".join(carry))
+	if frequencies:
+		edge_words = [word for word in edge_words if word]
+		total += len(edge_words)
+		table.update(tally(edge_words, normalize))
+	return total, table
+
+def word_count(path: str="alice.txt", processes: Optional[int]=None, chunk_size: int=CHUNK_SIZE) -> int:
+	count, _ = count_words(path, processes, chunk_size)
+	print(f"The file {os.path.basename(path)} has about {count} words")
 	return count
 
+def main(argv: "list[str]"=None):
+	parser = argparse.ArgumentParser(description="Count the words in a file over a pool of processes.")
+	parser.add_argument("file", nargs="?", default="alice.txt", help="File to count the words of.")
+	parser.add_argument("--processes", type=int, default=None, help="Worker processes. Defaults to one per CPU.")
+	parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Bytes per chunk.")
+	parser.add_argument("--top", type=int, default=0, help="Also print the N most common words.")
+	parser.add_argument("--normalize", action="store_true", help="Lowercase words and strip punctuation around them in the frequency table. Needs --top.")
+	args = parser.parse_args(argv)
+	if args.normalize and not args.top:
+		parser.error("--normalize only applies to the frequency table, so it needs --top")
+	if args.chunk_size < 1:
+		parser.error("--chunk-size must be at least 1")
+
+	if not args.top:
+		word_count(args.file, args.processes, args.chunk_size)
+		return
+	count, table = count_words(args.file, args.processes, args.chunk_size, frequencies=True, normalize=args.normalize)
+	print(f"The file {os.path.basename(args.file)} has about {count} words, {len(table)} different")
+	for word, n in table.most_common(args.top):
+		print(f"\t{n:>10} {word.decode(errors='replace')}")
+
 if __name__ == "__main__":
-	word_count()
+	main()
@@ -1,70 +1,126 @@
 #!/usr/bin/env python3
 import requests
 import datetime
-import redis
 import os
 import json
+import argparse
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Optional
 from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
 
-with open("token", "r") as f:
-	TOKEN = ''.join(f.readlines()).strip()
+from cache import Cache, open_backend
+from ratelimit import Scheduler
+from sessions import Commit, Session, Sessionizer, parse_time, format_time, write_csv
+from metrics import Metrics, endpoint_of
 
-BASE_URL = "https://api.github.com"
-r = redis.Redis(db=os.getenv("REDIS_DB") or 5)
+BASE_URL = os.getenv("GITHUB_API_URL") or "https://api.github.com"
+MAX_WORKERS = int(os.getenv("LOGBOOK_WORKERS") or 8)
+# LOGBOOK_CACHE is `redis`, `sqlite:path` or `dir:path`
+cache = Cache(open_backend(os.getenv("LOGBOOK_CACHE") or "redis"), max_bytes=int(os.getenv("LOGBOOK_CACHE_MB") or 64) * 1024 * 1024)
 
-def cached_get_page(url_str: str, page: int, redis_key_pfx: str, media_type: str="application/vnd.github.v3+json"):
+# one pooled session so requests reuse keep-alive connections instead of doing a new handshake every time
+http = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS, pool_block=True)
+http.mount("https://", adapter)
+http.mount("http://", adapter)
+# every request goes through here. LOGBOOK_RATE is requests per second.
+scheduler = Scheduler(http, max_workers=MAX_WORKERS, rate=float(os.getenv("LOGBOOK_RATE") or 15))
+# GraphQL has its own quota, so it's tracked separately
+graphql_scheduler = Scheduler(http, max_workers=MAX_WORKERS, rate=float(os.getenv("LOGBOOK_RATE") or 15))
+metrics = Metrics().install(cache, scheduler)
+
+@functools.cache
+def get_token() -> str:
+	if os.getenv("GITHUB_TOKEN"):
+		return os.getenv("GITHUB_TOKEN")
+	with open("token", "r") as f:
+		return ''.join(f.readlines()).strip()
+
+def fetch_many(fn, items, workers: int=MAX_WORKERS) -> list:
+	"""Call `fn` on every item using up to `workers` threads. Results are in the same order as `items`."""
+	items = list(items)
+	if len(items) <= 1 or workers <= 1:
+		return [fn(item) for item in items]
+	with ThreadPoolExecutor(max_workers=min(workers, len(items))) as pool:
+		return list(pool.map(fn, items))
+
+PREFETCH_CHUNK = 1000
+PER_PAGE = 100
+
+def prefetch(redis_key_pfxs: "list[str]") -> "list[tuple[str, object]]":
+	"""Get the cached `(etag, decoded result)` of many resources, with one backend call per chunk of misses."""
+	cached = []
+	for i in range(0, len(redis_key_pfxs), PREFETCH_CHUNK):
+		cached += cache.get_many(redis_key_pfxs[i:i + PREFETCH_CHUNK])
+	return cached
+
+def last_page_of(resp: requests.Response, page: int) -> Optional[int]:
+	"""
+	Get the number of the last page from the Link header. There is no Link header when everything fits on one page,
+	and the last page has no `next` or `last` link. Returns `None` if the response doesn't say.
+	"""
+	if "last" in resp.links:
+		return int(dict(parse_qsl(urlparse(resp.links["last"]["url"]).query))["page"])
+	if resp.status_code == 200 or "Link" in resp.headers:
+		return page if "next" not in resp.links else None
+	return None
+
+def cached_get_page(url_str: str, page: int, redis_key_pfx: str, media_type: str="application/vnd.github.v3+json", cached: "tuple[str, object]"=None):
+	"""`cached` is this page's `(etag, result)` from `prefetch`, if it has already been fetched."""
+	return fetch_page(url_str, page, redis_key_pfx, media_type, cached)[0]
+
+def fetch_page(url_str: str, page: int, redis_key_pfx: str, media_type: str="application/vnd.github.v3+json", cached: "tuple[str, object]"=None) -> "tuple[list, Optional[int]]":
+	"""Get a page, and the number of the last page if the response says what it is. The page is `None` if the request failed."""
 	assert len(redis_key_pfx) > 0
-	etag_key = f"{redis_key_pfx}:{page}:etag"
-	result_key = f"{redis_key_pfx}:{page}:result"
-	if r.exists(result_key) < 1:
-		r.delete(etag_key)
-	cached_etag = r.get(etag_key)
+	page_key_pfx = f"{redis_key_pfx}:{page}"
+	cached_etag, cached_result = cached or prefetch([page_key_pfx])[0]
 
 	url_parts = list(urlparse(url_str))
 	query = dict(parse_qsl(url_parts[4]))
 	query.update({
 		"page": page,
-		"perpage": 100,
+		"per_page": PER_PAGE,
 	})
 	url_parts[4] = urlencode(query)
 	url = urlunparse(url_parts)
 
-	resp = requests.get(url, headers={
-		"Authorization": f"token {TOKEN}",
+	resp = scheduler.get(url, headers={
+		"Authorization": f"token {get_token()}",
 		"If-None-Match": cached_etag,
 		"accept": media_type,
 	})
+	metrics.record_request(endpoint_of(redis_key_pfx), resp, cache.size_of(page_key_pfx))
 	print(f"rate limit: {resp.headers['X-RateLimit-Remaining']}/{resp.headers['X-RateLimit-Limit']} reset at {datetime.datetime.fromtimestamp(int(resp.headers['X-RateLimit-Reset']))}")
 	# print(f"link header: {resp.headers['Link']}")
 	if resp.status_code >= 400:
 		print(f"get paged resource failed: {resp.status_code} {resp.json()}")
-		return []
+		return None, page
 	if resp.status_code == 304:
 		print(f"cache hit: {redis_key_pfx} page {page}")
-		payload = r.get(result_key)
+		result = cached_result
 	elif resp.status_code == 200:
-		payload = resp.text
 		print(f"cache miss: {redis_key_pfx} page {page}")
-		r.set(result_key, payload)
-		r.set(etag_key, resp.headers.get("ETag"))
-	return json.loads(payload)
+		result = cache.put(page_key_pfx, resp.text, resp.headers.get("ETag"))
+	return result, last_page_of(resp, page)
 
-def cached_get_one(url: str, redis_key_pfx: str, media_type: str="application/vnd.github.v3+json", is_constant=False):
+def cached_get_one(url: str, redis_key_pfx: str, media_type: str="application/vnd.github.v3+json", is_constant=False, cached: "tuple[str, object]"=None):
+	"""`cached` is this resource's `(etag, result)` from `prefetch`, if it has already been fetched."""
 	assert len(redis_key_pfx) > 0
+	cached_etag, cached_result = cached or prefetch([redis_key_pfx])[0]
 	if is_constant:
-		try:
-			payload = r.get(f"{redis_key_pfx}:result")
-			return json.loads(payload)
-		except:
-			print("constant resource not found in cache")
-
-	cached_etag = r.get(f"{redis_key_pfx}:etag")
+		if cached_result is not None:
+			metrics.record_cached(endpoint_of(redis_key_pfx), cache.size_of(redis_key_pfx))
+			return cached_result
+		print("constant resource not found in cache")
 
-	resp = requests.get(url, headers={
-		"Authorization": f"token {TOKEN}",
+	resp = scheduler.get(url, headers={
+		"Authorization": f"token {get_token()}",
 		"If-None-Match": cached_etag,
 		"accept": media_type,
 	})
+	metrics.record_request(endpoint_of(redis_key_pfx), resp, cache.size_of(redis_key_pfx))
 	print(f"rate limit: {resp.headers['X-RateLimit-Remaining']}/{resp.headers['X-RateLimit-Limit']} reset at {datetime.datetime.fromtimestamp(int(resp.headers['X-RateLimit-Reset']))}")
 	# print(f"link header: {resp.headers['Link']}")
 	if resp.status_code >= 400:
@@ -72,28 +128,56 @@ def cached_get_one(url: str, redis_key_pfx: str, media_type: str="application/vn
 		return None
 	if resp.status_code == 304:
 		print(f"cache hit: {redis_key_pfx}")
-		payload = r.get(f"{redis_key_pfx}:result")
+		result = cached_result
 	elif resp.status_code == 200:
-		payload = resp.text
 		print(f"cache miss: {redis_key_pfx}")
-		r.set(f"{redis_key_pfx}:result", payload)
-		r.set(f"{redis_key_pfx}:etag", resp.headers.get("ETag"))
-	return json.loads(payload)
+		result = cache.put(redis_key_pfx, resp.text, resp.headers.get("ETag"))
+	return result
 
-def get_all_events(username):
-	page = 0
-	url = f"{BASE_URL}/users/{username}/events/public"
+def get_pages(url: str, redis_key_pfx: str):
+	"""
+	Yield the items on every page of a listing. The first page's Link header says how many pages there are, and the
+	rest are fetched concurrently. If it doesn't say, pages are fetched `MAX_WORKERS` at a time until one is empty.
+
+	If the first page fails, there's nothing to list. If a later page fails, `requests.HTTPError` is raised once the
+	pages before it are out, instead of ending the listing early.
+	"""
+	items, last_page = fetch_page(url, 1, redis_key_pfx)
+	if not items:
+		return
+	yield from items
+
+	def get_page(job: "tuple[int, tuple[str, object]]") -> list:
+		items = cached_get_page(url, job[0], redis_key_pfx, cached=job[1])
+		if items is None:
+			raise requests.HTTPError(f"page {job[0]} of {redis_key_pfx} failed, the listing would be incomplete")
+		return items
+
+	if last_page is not None:
+		rest = range(2, last_page + 1)
+		cached = prefetch([f"{redis_key_pfx}:{p}" for p in rest])
+		for items in fetch_many(get_page, zip(rest, cached)):
+			yield from items
+		return
+
+	page = 2
 	while True:
-		events = cached_get_page(url, page, f"events:{username}")
-		if not events:
-			break
+		window = range(page, page + MAX_WORKERS)
+		cached = prefetch([f"{redis_key_pfx}:{p}" for p in window])
+		pages = fetch_many(get_page, zip(window, cached))
+		for items in pages:
+			if not items:
+				return
+			yield from items
+		page += MAX_WORKERS
 
-		for event in events:
-			if isinstance(event, str):
-				print(f"what the fuck? got {event}")
-				continue
-			yield event
-		page += 1
+def get_all_events(username):
+	url = f"{BASE_URL}/users/{username}/events/public"
+	for event in get_pages(url, f"events:{username}"):
+		if isinstance(event, str):
+			print(f"what the fuck? got {event}")
+			continue
+		yield event
 
 def get_filtered_events(username, types=["PushEvent", "PullRequestEvent"], since=None):
 	if since:
@@ -111,18 +195,10 @@ def get_filtered_events(username, types=["PushEvent", "PullRequestEvent"], since
 		yield event
 
 def get_commits(repo: dict, author: str, since=None, branch=None):
-	page = 0
-	while True:
-		if branch:
-			commits = cached_get_page(f"{repo['url']}/commits?author={author}&since={since}&sha={branch}", page, f"commits:{repo['name']}:{author}:{branch}")
-		else:
-			commits = cached_get_page(f"{repo['url']}/commits?author={author}&since={since}", page, f"commits:{repo['name']}:{author}")
-		if not commits:
-			break
-		for commit in commits:
-			yield commit
-
-		page += 1
+	if branch:
+		yield from get_pages(f"{repo['url']}/commits?author={author}&since={since}&sha={branch}", f"commits:{repo['name']}:{author}:{branch}")
+	else:
+		yield from get_pages(f"{repo['url']}/commits?author={author}&since={since}", f"commits:{repo['name']}:{author}")
 
 def parse_gh_time(s) -> datetime.datetime:
 	return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ")
@@ -149,107 +225,202 @@ ext_to_language = {
 }
 IGNORE_EXTS = ["mod", "sum", "gitignore", "gitmodules", "jpg", "jpeg", "png", "gif", "mp4", "tour", "txt", "ini", "conf"]
 
-if __name__ == "__main__":
-	USERNAME = 'dyc3'
-	SINCE = '2021-03-30'
-	repos = {}
-	for event in get_filtered_events(USERNAME, since=SINCE):
+MAX_GAP = datetime.timedelta(hours=3)
+MIN_SESSION = datetime.timedelta(minutes=20)
+
+def commit_record(repo: dict, commit: dict) -> Commit:
+	"""The parts of a listed commit that sessions need, small enough to keep in the state file."""
+	return Commit(parse_time(commit["commit"]["author"]["date"]), commit["author"]["login"], repo["name"], commit["sha"], commit["commit"]["message"], commit["url"])
+
+GRAPHQL_BATCH = 50
+
+def graphql_commit_stats(commits: "list[tuple[str, str]]") -> "list[Optional[dict]]":
+	"""
+	Get the line counts of many `(repo name, sha)` commits with one GraphQL query, aliasing every repo and sha. They
+	come back shaped like the REST API's commits, except that GraphQL can't list the files, so `files` is `None`
+	unless the commit changed no files at all. Commits that weren't found are `None`.
+	"""
+	repos: "dict[str, list[str]]" = {}
+	for repo_name, sha in commits:
+		repos.setdefault(repo_name, []).append(sha)
+	fields = []
+	for i, (repo_name, shas) in enumerate(repos.items()):
+		owner, name = repo_name.split("/", 1)
+		objects = " ".join(f"c{j}: object(oid: {json.dumps(sha)}) {{ ... on Commit {{ additions deletions changedFilesIfAvailable }} }}" for j, sha in enumerate(shas))
+		fields.append(f"r{i}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{ {objects} }}")
+	resp = graphql_scheduler.request("POST", f"{BASE_URL}/graphql", headers={"Authorization": f"bearer {get_token()}"}, json={"query": f"query {{ {' '.join(fields)} }}"})
+	metrics.record_request("graphql", resp)
+	if resp.status_code >= 400:
+		print(f"graphql query failed: {resp.status_code} {resp.text}")
+		return [None] * len(commits)
+	data = resp.json().get("data") or {}
+	found = {}
+	for i, (repo_name, shas) in enumerate(repos.items()):
+		for j, sha in enumerate(shas):
+			commit = (data.get(f"r{i}") or {}).get(f"c{j}")
+			if not commit:
+				continue
+			found[(repo_name, sha)] = {
+				"sha": sha,
+				"stats": {"additions": commit["additions"], "deletions": commit["deletions"], "total": commit["additions"] + commit["deletions"]},
+				"files": [] if commit["changedFilesIfAvailable"] == 0 else None,
+			}
+	return [found.get(commit) for commit in commits]
+
+def add_details(sessions: "list[Session]", bulk: bool=False, languages: bool=True):
+	"""
+	Add the line counts and languages of the commits in `sessions` that haven't been counted yet.
+
+	With `bulk`, commits that aren't cached yet get their line counts from GraphQL, `GRAPHQL_BATCH` per request. The
+	REST API is then only used for the file lists, when `languages` are wanted.
+	"""
+	jobs = [(session, commit) for session in sessions for commit in session.commits[session.counted:]]
+	keys = [f"commit:{session.repo}:{commit.sha}" for session, commit in jobs]
+	cached = prefetch(keys)
+	if bulk:
+		missing = [i for i, (_, result) in enumerate(cached) if result is None]
+		batches = [missing[i:i + GRAPHQL_BATCH] for i in range(0, len(missing), GRAPHQL_BATCH)]
+		stats = fetch_many(lambda batch: graphql_commit_stats([(jobs[i][0].repo, jobs[i][1].sha) for i in batch]), batches)
+		for batch, results in zip(batches, stats):
+			for i, result in zip(batch, results):
+				if result is not None:
+					cached[i] = (None, cache.put(keys[i], json.dumps(result), None))
+	if languages:
+		# counts from GraphQL don't say which files changed
+		cached = [(None, None) if result is not None and result["files"] is None else (etag, result) for etag, result in cached]
+	details = fetch_many(lambda job: cached_get_one(job[0][1].url, job[1], is_constant=True, cached=job[2]), zip(jobs, keys, cached))
+	for (session, commit), data in zip(jobs, details):
+		if not data:
+			print(f"commit doesn't exist? {session.repo} {commit.sha}")
+			continue
+		session.additions += data['stats']['additions']
+		session.deletions += data['stats']['deletions']
+		if not languages:
+			continue
+		for file in data['files']:
+			if file['filename'].startswith(".") or '.' not in file['filename']:
+				continue
+			ext = file['filename'].split(".")[-1]
+			if ext in IGNORE_EXTS:
+				continue
+			if ext_to_language[ext] not in session.languages:
+				session.languages.append(ext_to_language[ext])
+	for session in sessions:
+		session.counted = len(session.commits)
+
+def load_state(path: str) -> Optional[dict]:
+	if not path or not os.path.exists(path):
+		return None
+	with open(path, "r") as f:
+		return json.load(f)
+
+def save_state(path: str, state: dict):
+	"""Replace the state file atomically, so a crash leaves either the old state or the new one."""
+	tmp_path = f"{path}.tmp"
+	with open(tmp_path, "w") as f:
+		json.dump(state, f)
+	os.replace(tmp_path, path)
+
+def run(username: str, since: str, output: str="logbook.csv", state_path: str=None, now: int=None, bulk: bool=False, languages: bool=True) -> "list[Session]":
+	"""
+	Build the logbook of `username`'s coding sessions since `since`, and write it to `output`.
+
+	With a `state_path`, the run is incremental. Each repo has a watermark at its newest commit, and only commits after
+	it are fetched. New commits extend the session that was left open last time. Sessions that can't grow any more
+	are appended to `output`, and the rest are saved in the state file for the next run.
+
+	`now` is seconds since the epoch, and `bulk` and `languages` are passed on to `add_details`.
+	"""
+	now = now or int(datetime.datetime.now(datetime.timezone.utc).timestamp())
+	state = load_state(state_path)
+	append = state is not None
+	state = state or {"events_since": None, "repos": {}, "watermarks": {}, "open": []}
+
+	repos = state["repos"]
+	events_since = state["events_since"] or since
+	for event in get_filtered_events(username, since=events_since):
 		repos[event['repo']['name']] = event['repo']
+		events_since = max(events_since, parse_gh_time(event['created_at']).isoformat())
 		print(f"event: {event['id']} {event['type'].ljust(20)} {event['repo']['name'].ljust(30)} {event['created_at']}")
-	repos = list(repos.values())
-	print(f"repos: {repos}")
-
-	max_time_delta = datetime.timedelta(hours=3)
-
-	coding_sessions = []
-	for repo in repos:
-		current_session = []
-		def push_session():
-			global coding_sessions
-			global current_session
-			coding_sessions += [{
-				"repo": repo,
-				"commits": current_session[::-1],
-				"duration": None,
-				"additions": 0,
-				"deletions": 0,
-				"languages": set(),
-			}]
-			current_session = []
-		repo_data = cached_get_one(repo['url'], f"repo:{repo['name']}")
-
-		# for commit in get_commits(repo, USERNAME, since=SINCE, branch=repo_data['default_branch']):
-		for commit in get_commits(repo, USERNAME, since=SINCE):
+	state["events_since"] = events_since
+	print(f"repos: {list(repos.values())}")
+
+	def new_commits(repo: dict) -> "list[Commit]":
+		watermark = state["watermarks"].get(repo["name"])
+		commits = []
+		for commit in get_commits(repo, username, since=format_time(watermark["time"]) if watermark else since):
 			# author = person who wrote the code
 			# committer = person who committed it to the repo
 			if commit['author']['login'] != commit['committer']['login']:
-				# skip
 				continue
-
-			print(f"commit: {commit['sha']} {commit['author']['login']} {commit['commit']['author']['date']} {commit['committer']['login']}")
-			if not current_session:
-				current_session = [commit]
+			commit = commit_record(repo, commit)
+			# `since` includes commits at the watermark itself
+			if watermark and (commit.time < watermark["time"] or (commit.time == watermark["time"] and commit.sha in watermark["shas"])):
 				continue
-			last_commit_time = parse_gh_time(current_session[-1]['commit']['author']['date'])
-			commit_time = parse_gh_time(commit['commit']['author']['date'])
-			# print(f"delta: {last_commit_time - commit_time}")
-			delta = last_commit_time - commit_time
-			if delta >= datetime.timedelta(0) and delta <= max_time_delta:
-				current_session += [commit]
-			else:
-				push_session()
-		if current_session:
-			push_session()
-
-	min_session_time = datetime.timedelta(minutes=20)
+			commits.append(commit)
+		commits.sort(key=lambda commit: commit.time)
+		return commits
 
-	total_time = datetime.timedelta(0)
-	total_commits = 0
-	total_additions = 0
-	total_deletions = 0
-	for i, session in enumerate(coding_sessions):
-		first_commit_time = parse_gh_time(session["commits"][0]['commit']['author']['date'])
-		last_commit_time = parse_gh_time(session["commits"][-1]['commit']['author']['date'])
-		delta = last_commit_time - first_commit_time
-		assert delta >= datetime.timedelta(0)
-		duration = max(delta, min_session_time) # + datetime.timedelta(minutes=20)
-		print(f"session {i}: {session['repo']['name']} {len(session['commits'])} commits, {duration}")
-		total_time += duration
-		session["duration"] = duration
-
-		# compile lines of code, languages
-		total_commits += len(session['commits'])
-		for commit in session['commits']:
-			data = cached_get_one(commit['url'], f"commit:{session['repo']['name']}:{commit['sha']}", is_constant=True)
-			if not data:
-				print(f"commit doesn't exist? {session['repo']['name']} {commit['sha']}")
-				continue
+	sessionizer = Sessionizer(MAX_GAP)
+	for session in state["open"]:
+		sessionizer.resume(Session.from_dict(session))
+
+	# fetch the new commits of every repo at once
+	closed = []
+	for repo, commits in zip(list(repos.values()), fetch_many(new_commits, repos.values())):
+		if not commits:
+			continue
+		for commit in commits:
+			print(f"commit: {commit.sha} {repo['name']} {format_time(commit.time)}")
+			session = sessionizer.add(commit)
+			if session is not None:
+				closed.append(session)
+		watermark = state["watermarks"].get(repo["name"], {"time": None, "shas": []})
+		last = commits[-1].time
+		shas = watermark["shas"] if last == watermark["time"] else []
+		state["watermarks"][repo["name"]] = {"time": last, "shas": shas + [commit.sha for commit in commits if commit.time == last]}
 
-			session["additions"] += data['stats']['additions']
-			session["deletions"] += data['stats']['deletions']
-			for file in data['files']:
-				if file['filename'].startswith(".") or '.' not in file['filename']:
-					continue
-				ext = file['filename'].split(".")[-1]
-				if ext in IGNORE_EXTS:
-					continue
-				session["languages"] |= {ext_to_language[ext]}
-		total_additions += session["additions"]
-		total_deletions += session["deletions"]
+	# a session is done once it's been quiet for longer than the gap. Without a state file, everything is written now.
+	closed += sessionizer.expire(now) if state_path else sessionizer.close_all()
+	still_open = list(sessionizer.open.values())
+	add_details(closed + still_open, bulk, languages)
+	state["open"] = [session.to_dict() for session in still_open]
+	closed.sort(key=lambda session: session.start)
 
+	total_time = datetime.timedelta(0)
+	for i, session in enumerate(closed):
+		print(f"session {i}: {session.repo} {len(session.commits)} commits, {session.duration(MIN_SESSION)}")
+		total_time += session.duration(MIN_SESSION)
 	print("Summary:")
-	print(f"{len(coding_sessions)} coding sessions since {SINCE} for a total of {total_time}")
+	print(f"{len(closed)} coding sessions since {since} for a total of {total_time}")
 	print(f"{len(repos)} repos")
-	print(f"\t{total_commits} commits")
-	print(f"\t{total_additions} additions")
-	print(f"\t{total_deletions} deletions")
-
-	coding_sessions.sort(key=lambda key: key['commits'][0]['commit']['author']['date'])
+	print(f"\t{sum(len(session.commits) for session in closed)} commits")
+	print(f"\t{sum(session.additions for session in closed)} additions")
+	print(f"\t{sum(session.deletions for session in closed)} deletions")
+	if state["open"]:
+		print(f"{len(state['open'])} sessions still open")
 
 	# output csv
-	with open("logbook.csv", "w") as f:
-		f.write(f"date,project,languages,lines of code,time spent,reflection\n")
-		for session in coding_sessions:
-			reflection = ', '.join([c['commit']['message'].replace("\n", " ") for c in session['commits']])
-			languages = ', '.join(session['languages'])
-			f.write(f"{session['commits'][0]['commit']['author']['date']},{session['repo']['name']},\"{languages}\",+{session['additions']} / -{session['deletions']},{session['duration']},\"{reflection}\"\n")
+	with open(output, "a" if append else "w", newline="") as f:
+		write_csv(f, closed, MIN_SESSION, header=not append)
+	if state_path:
+		save_state(state_path, state)
+	metrics.report()
+	return closed
+
+def main(argv: "list[str]"=None):
+	parser = argparse.ArgumentParser(description="Build a logbook of coding sessions from GitHub activity.")
+	parser.add_argument("--user", default="dyc3")
+	parser.add_argument("--since", default="2021-03-30")
+	parser.add_argument("--output", default="logbook.csv")
+	parser.add_argument("--state", metavar="PATH", help="Run incrementally, keeping watermarks and open sessions in this file and appending to the output.")
+	parser.add_argument("--graphql", action="store_true", help="Get commit line counts from GraphQL in bulk instead of one REST request per commit.")
+	parser.add_argument("--no-languages", dest="languages", action="store_false", help="Leave out languages, so file lists are never fetched.")
+	parser.add_argument("--metrics", metavar="PATH", help="Save fetch and cache metrics as JSON.")
+	args = parser.parse_args(argv)
+	run(args.user, args.since, args.output, args.state, bulk=args.graphql, languages=args.languages)
+	if args.metrics:
+		metrics.export(args.metrics)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,220 @@
+"""
+Response cache for autologbook.
+
+Lookups go through an in-process LRU of decoded JSON first, sized by payload bytes, and only fall through to the
+persistent backend on a miss. The backend can be Redis, a SQLite file, or a directory, so runs work offline too.
+Payloads are zlib compressed in the backend. Values written before compression was added are still read as plain
+JSON.
+
+Each resource is kept as two keys, `{prefix}:etag` and `{prefix}:result`.
+"""
+
+import os
+import json
+import zlib
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+# marks a compressed value. JSON text can't start with a null byte, so old uncompressed values are told apart by it.
+COMPRESSED = b"\0z"
+COMPRESS_MIN = 256
+
+def encode(payload: bytes, level: int=6) -> bytes:
+	if len(payload) < COMPRESS_MIN:
+		return payload
+	return COMPRESSED + zlib.compress(payload, level)
+
+def decode(value: bytes) -> bytes:
+	if value.startswith(COMPRESSED):
+		return zlib.decompress(value[len(COMPRESSED):])
+	return value
+
+class RedisBackend:
+	"""Keys in Redis. Reads are one MGET and writes are one pipeline."""
+
+	def __init__(self, client):
+		self.client = client
+
+	def get_many(self, keys: "list[str]") -> "list[Optional[bytes]]":
+		return self.client.mget(keys)
+
+	def write(self, values: "dict[str, bytes]", delete: "list[str]"=()):
+		pipe = self.client.pipeline(transaction=False)
+		if values:
+			pipe.mset(values)
+		if delete:
+			pipe.delete(*delete)
+		pipe.execute()
+
+class SQLiteBackend:
+	"""Keys in a table in a local SQLite file. Shared between threads behind a lock."""
+
+	CHUNK = 500
+
+	def __init__(self, path: str):
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+		self.db.commit()
+		self.lock = threading.Lock()
+
+	def get_many(self, keys: "list[str]") -> "list[Optional[bytes]]":
+		found = {}
+		with self.lock:
+			for i in range(0, len(keys), self.CHUNK):
+				chunk = keys[i:i + self.CHUNK]
+				found.update(self.db.execute(f"SELECT key, value FROM cache WHERE key IN ({','.join('?' * len(chunk))})", chunk))
+		return [found.get(key) for key in keys]
+
+	def write(self, values: "dict[str, bytes]", delete: "list[str]"=()):
+		with self.lock, self.db:
+			self.db.executemany("INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)", values.items())
+			self.db.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in delete])
+
+	def close(self):
+		self.db.close()
+
+class DirectoryBackend:
+	"""One file per key, named by the key's hash. Files are replaced atomically, so readers never see half a value."""
+
+	def __init__(self, path: str):
+		self.path = path
+		os.makedirs(path, exist_ok=True)
+
+	def file_of(self, key: str) -> str:
+		digest = hashlib.sha1(key.encode()).hexdigest()
+		return os.path.join(self.path, digest[:2], digest[2:])
+
+	def get_many(self, keys: "list[str]") -> "list[Optional[bytes]]":
+		values = []
+		for key in keys:
+			try:
+				with open(self.file_of(key), "rb") as f:
+					values.append(f.read())
+			except FileNotFoundError:
+				values.append(None)
+		return values
+
+	def write(self, values: "dict[str, bytes]", delete: "list[str]"=()):
+		for key, value in values.items():
+			path = self.file_of(key)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			tmp_path = f"{path}.{threading.get_ident()}.tmp"
+			with open(tmp_path, "wb") as f:
+				f.write(value)
+			os.replace(tmp_path, path)
+		for key in delete:
+			try:
+				os.remove(self.file_of(key))
+			except FileNotFoundError:
+				pass
+
+def open_backend(spec: str):
+	"""
+	Backend from a spec like `redis`, `redis:5` (database number), `sqlite:cache.db` or `dir:cache/`. Redis is only
+	imported when it's used.
+	"""
+	kind, _, arg = spec.partition(":")
+	if kind == "sqlite":
+		return SQLiteBackend(arg or "logbook-cache.db")
+	if kind == "dir":
+		return DirectoryBackend(arg or "logbook-cache")
+	if kind == "redis":
+		import redis
+		return RedisBackend(redis.Redis(db=arg or os.getenv("REDIS_DB") or 5))
+	raise ValueError(f"unknown cache backend: {spec}")
+
+class Cache:
+	"""
+	Decoded responses and their etags, kept in memory up to `max_bytes` of payload and backed by `backend`.
+
+	Results are shared between everyone who asks for them, so they must not be modified.
+	"""
+
+	def __init__(self, backend, max_bytes: int=64 * 1024 * 1024, level: int=6):
+		self.backend = backend
+		self.max_bytes = max_bytes
+		self.level = level
+		self.memory: "OrderedDict[str, tuple[Optional[str], Any, int]]" = OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+		self.memory_hits = 0
+		self.backend_hits = 0
+		self.misses = 0
+
+	def remember(self, prefix: str, etag: Optional[str], result: Any, size: int):
+		with self.lock:
+			if prefix in self.memory:
+				self.size -= self.memory.pop(prefix)[2]
+			if size > self.max_bytes:
+				return
+			self.memory[prefix] = (etag, result, size)
+			self.size += size
+			while self.size > self.max_bytes:
+				self.size -= self.memory.popitem(last=False)[1][2]
+
+	def load(self, payload: bytes) -> Any:
+		return json.loads(payload)
+
+	def size_of(self, prefix: str) -> int:
+		"""Payload size of a result held in memory, or 0 if it isn't."""
+		entry = self.memory.get(prefix)
+		return entry[2] if entry else 0
+
+	def forget(self):
+		"""Drop everything held in memory. The backend is left alone."""
+		with self.lock:
+			self.memory.clear()
+			self.size = 0
+
+	def get_many(self, prefixes: "list[str]") -> "list[tuple[Optional[str], Any]]":
+		"""
+		Get the cached `(etag, result)` of every prefix, from memory where possible and from the backend in one call
+		otherwise. A resource that isn't cached is `(None, None)`. An etag without a result is useless (a 304 would
+		leave us with nothing), so it comes back as `None` too.
+		"""
+		found = [None] * len(prefixes)
+		missing = []
+		with self.lock:
+			for i, prefix in enumerate(prefixes):
+				entry = self.memory.get(prefix)
+				if entry is None:
+					missing.append(i)
+					continue
+				self.memory.move_to_end(prefix)
+				found[i] = entry[:2]
+			self.memory_hits += len(prefixes) - len(missing)
+		if not missing:
+			return found
+
+		values = self.backend.get_many([key for i in missing for key in (f"{prefixes[i]}:etag", f"{prefixes[i]}:result")])
+		misses = values[1::2].count(None)
+		with self.lock:
+			self.misses += misses
+			self.backend_hits += len(missing) - misses
+		for i, etag, value in zip(missing, values[::2], values[1::2]):
+			if value is None:
+				found[i] = (None, None)
+				continue
+			payload = decode(value)
+			etag = etag.decode() if etag is not None else None
+			result = self.load(payload)
+			self.remember(prefixes[i], etag, result, len(payload))
+			found[i] = (etag, result)
+		return found
+
+	def put(self, prefix: str, payload: str, etag: Optional[str]) -> Any:
+		"""Cache a response and its etag, and return the decoded response."""
+		raw = payload.encode()
+		result = self.load(raw)
+		self.remember(prefix, etag, result, len(raw))
+		value = encode(raw, self.level)
+		if etag:
+			self.backend.write({f"{prefix}:result": value, f"{prefix}:etag": etag.encode()})
+		else:
+			self.backend.write({f"{prefix}:result": value}, delete=[f"{prefix}:etag"])
+		return result
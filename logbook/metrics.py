@@ -0,0 +1,199 @@
+"""
+Fetch and cache metrics for autologbook.
+
+Counts every request by endpoint and outcome (200, 304, error, or served from the cache without a request) along with
+how long the network took. Backend round trips and JSON decoding are timed too, so a summary shows whether the
+network, the cache backend, or decoding dominates a run.
+"""
+
+import sys
+import json
+import math
+import time
+import threading
+from typing import TextIO
+
+import requests
+
+class Timings:
+	"""
+	Every duration recorded for one kind of call, in seconds. A run makes thousands of requests at most, not millions,
+	so they're all kept and percentiles are exact.
+	"""
+
+	def __init__(self):
+		self.seconds: "list[float]" = []
+		self.sorted = True
+
+	def add(self, seconds: float):
+		if self.seconds and seconds < self.seconds[-1]:
+			self.sorted = False
+		self.seconds.append(seconds)
+
+	def percentile(self, p: float) -> float:
+		"""The duration that `p` percent of the calls took at most, by nearest rank."""
+		if not self.seconds:
+			return 0.0
+		if not self.sorted:
+			self.seconds.sort()
+			self.sorted = True
+		return self.seconds[max(math.ceil(p / 100 * len(self.seconds)) - 1, 0)]
+
+	def to_dict(self) -> dict:
+		total = math.fsum(self.seconds)
+		return {
+			"count": len(self.seconds),
+			"total_ms": total * 1000,
+			"mean_ms": total / len(self.seconds) * 1000 if self.seconds else 0,
+			"p50_ms": self.percentile(50) * 1000,
+			"p90_ms": self.percentile(90) * 1000,
+			"p99_ms": self.percentile(99) * 1000,
+		}
+
+class TimedBackend:
+	"""Wraps a cache backend to time its round trips."""
+
+	def __init__(self, backend, metrics: "Metrics"):
+		self.backend = backend
+		self.metrics = metrics
+
+	def get_many(self, keys: "list[str]") -> list:
+		start = time.perf_counter()
+		try:
+			return self.backend.get_many(keys)
+		finally:
+			self.metrics.record_timing(self.metrics.backend["get"], time.perf_counter() - start)
+
+	def write(self, values: dict, delete: "list[str]"=()):
+		start = time.perf_counter()
+		try:
+			return self.backend.write(values, delete)
+		finally:
+			self.metrics.record_timing(self.metrics.backend["write"], time.perf_counter() - start)
+
+	def __getattr__(self, name):
+		return getattr(self.backend, name)
+
+class Metrics:
+	"""
+	`install` wraps a cache's backend and JSON decoding to time them, and `uninstall` puts the originals back.
+	Requests are recorded by whoever makes them, with `record_request` and `record_cached`.
+	"""
+
+	OUTCOMES = ("200", "304", "error", "cached")
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.perf_counter()
+		self.latency: "dict[str, Timings]" = {}
+		self.outcomes: "dict[str, dict[str, int]]" = {}
+		self.backend = {"get": Timings(), "write": Timings()}
+		self.decode = Timings()
+		self.bytes_downloaded = 0
+		self.bytes_from_cache = 0
+		# per rate limit resource (core, graphql, ...): requests that used quota, and the last known remaining quota
+		self.rate: "dict[str, dict[str, int]]" = {}
+		self.cache = None
+		self.scheduler = None
+
+	def install(self, cache, scheduler=None) -> "Metrics":
+		self.cache = cache
+		self.scheduler = scheduler
+		cache.backend = TimedBackend(cache.backend, self)
+		load = cache.load
+		def timed_load(payload: bytes):
+			start = time.perf_counter()
+			try:
+				return load(payload)
+			finally:
+				self.record_timing(self.decode, time.perf_counter() - start)
+		cache.load = timed_load
+		return self
+
+	def uninstall(self):
+		if self.cache is None:
+			return
+		self.cache.backend = self.cache.backend.backend
+		del self.cache.load
+		self.cache = None
+
+	def record_timing(self, timings: Timings, seconds: float):
+		with self.lock:
+			timings.add(seconds)
+
+	def count(self, endpoint: str, outcome: str):
+		if endpoint not in self.outcomes:
+			self.outcomes[endpoint] = dict.fromkeys(self.OUTCOMES, 0)
+			self.latency[endpoint] = Timings()
+		self.outcomes[endpoint][outcome] += 1
+
+	def record_request(self, endpoint: str, resp: requests.Response, cached_bytes: int=0):
+		"""Record a response. `cached_bytes` is the size of the cached copy that a 304 let us use."""
+		if resp.status_code >= 400:
+			outcome = "error"
+		elif resp.status_code == 304:
+			outcome = "304"
+		else:
+			outcome = "200"
+		with self.lock:
+			self.count(endpoint, outcome)
+			self.latency[endpoint].add(resp.elapsed.total_seconds())
+			self.bytes_downloaded += len(resp.content)
+			if outcome == "304":
+				self.bytes_from_cache += cached_bytes
+			if "X-RateLimit-Remaining" in resp.headers:
+				rate = self.rate.setdefault(resp.headers.get("X-RateLimit-Resource", "core"), {"used": 0, "remaining": None, "limit": None})
+				# 304s don't count against the quota
+				if outcome != "304":
+					rate["used"] += 1
+				rate["remaining"] = int(resp.headers["X-RateLimit-Remaining"])
+				rate["limit"] = int(resp.headers["X-RateLimit-Limit"])
+
+	def record_cached(self, endpoint: str, cached_bytes: int):
+		"""Record a resource served from the cache without a request."""
+		with self.lock:
+			self.count(endpoint, "cached")
+			self.bytes_from_cache += cached_bytes
+
+	def summary(self) -> dict:
+		with self.lock:
+			result = {
+				"elapsed": time.perf_counter() - self.started,
+				"endpoints": {endpoint: {**self.outcomes[endpoint], "latency": self.latency[endpoint].to_dict()} for endpoint in self.outcomes},
+				"backend": {name: timings.to_dict() for name, timings in self.backend.items()},
+				"decode": self.decode.to_dict(),
+				"bytes_downloaded": self.bytes_downloaded,
+				"bytes_from_cache": self.bytes_from_cache,
+				"rate_limit": {resource: dict(rate) for resource, rate in self.rate.items()},
+			}
+		if self.cache is not None:
+			result["cache"] = {"memory_hits": self.cache.memory_hits, "backend_hits": self.cache.backend_hits, "misses": self.cache.misses}
+		if self.scheduler is not None:
+			result["scheduler"] = {"retries": self.scheduler.retries, "waited": self.scheduler.waited}
+		return result
+
+	def report(self, f: TextIO=sys.stdout):
+		"""Print a readable summary."""
+		summary = self.summary()
+		print(f"Fetch metrics ({summary['elapsed']:.1f}s):", file=f)
+		for endpoint, stats in summary["endpoints"].items():
+			latency = stats["latency"]
+			print(f"\t{endpoint.ljust(10)} 200: {stats['200']:<6} 304: {stats['304']:<6} error: {stats['error']:<6} cached: {stats['cached']:<6} network p50 {latency['p50_ms']:.1f} ms, p99 {latency['p99_ms']:.1f} ms, total {latency['total_ms'] / 1000:.2f}s", file=f)
+		for name, stats in summary["backend"].items():
+			print(f"\tcache {name.ljust(5)} {stats['count']} round trips, p50 {stats['p50_ms']:.2f} ms, total {stats['total_ms'] / 1000:.2f}s", file=f)
+		print(f"\tjson decode {summary['decode']['count']} payloads, total {summary['decode']['total_ms'] / 1000:.2f}s", file=f)
+		print(f"\t{summary['bytes_downloaded']} bytes downloaded, {summary['bytes_from_cache']} bytes served from cache", file=f)
+		if "cache" in summary:
+			print(f"\tcache: {summary['cache']['memory_hits']} memory hits, {summary['cache']['backend_hits']} backend hits, {summary['cache']['misses']} misses", file=f)
+		if "scheduler" in summary:
+			print(f"\trate limit waits: {summary['scheduler']['waited']:.1f}s, {summary['scheduler']['retries']} retries", file=f)
+		for resource, rate in summary["rate_limit"].items():
+			print(f"\trate limit {resource}: used {rate['used']}, {rate['remaining']}/{rate['limit']} left", file=f)
+
+	def export(self, path: str):
+		with open(path, "w") as f:
+			json.dump(self.summary(), f, indent="\t")
+
+def endpoint_of(redis_key_pfx: str) -> str:
+	"""Name of the endpoint a cache key is for, like `commits` for `commits:dyc3/repo:dyc3`."""
+	return redis_key_pfx.split(":", 1)[0]
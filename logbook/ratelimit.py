@@ -0,0 +1,159 @@
+"""
+Request scheduling that respects GitHub's rate limits.
+
+Every request goes through a `Scheduler`, which:
+
+- paces requests with a token bucket, to stay under the secondary rate limit on requests per minute
+- tracks the remaining primary quota from the `X-RateLimit-*` headers. Once it's used up, requests wait for the reset
+  instead of failing
+- runs fewer requests at once as the quota runs low
+- lets conditional requests (with `If-None-Match`) through even when the quota is low, because a 304 doesn't count
+  against it
+- retries requests that hit a rate limit, after `Retry-After` or with exponential backoff, and raises `RateLimited`
+  once the retries run out
+"""
+
+import time
+import threading
+import email.utils
+from typing import Optional
+
+import requests
+
+class RateLimited(requests.HTTPError):
+	"""A request was still rate limited after its last retry. The last response is in `response`."""
+
+def retry_after(value: str) -> Optional[float]:
+	"""Seconds to wait from a `Retry-After` header, which is either a number of seconds or an HTTP date."""
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+	try:
+		return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+	except (TypeError, ValueError):
+		return None
+
+class Scheduler:
+	def __init__(self, session: requests.Session, max_workers: int=8, rate: float=15.0, burst: int=30, reserve: int=0, max_retries: int=5, backoff: float=1.0):
+		"""
+		`rate` is requests per second, with bursts of up to `burst`. `reserve` is how much of the quota is left for
+		conditional requests only.
+		"""
+		self.session = session
+		self.max_workers = max_workers
+		self.rate = rate
+		self.burst = burst
+		self.reserve = reserve
+		self.max_retries = max_retries
+		self.backoff = backoff
+
+		self.cond = threading.Condition()
+		self.tokens = float(burst)
+		self.refilled = time.monotonic()
+		self.active = 0
+		# unconditional requests in flight, which will each use up some of the quota
+		self.reserved = 0
+		self.limit: Optional[int] = None
+		self.remaining: Optional[int] = None
+		self.reset: Optional[float] = None
+		self.retries = 0
+		# seconds spent waiting for the rate limits
+		self.waited = 0.0
+
+	def concurrency(self) -> int:
+		"""Full concurrency while over a tenth of the quota is left, then fewer requests at once down to one."""
+		if self.remaining is None or not self.limit:
+			return self.max_workers
+		low = self.limit / 10
+		if self.remaining >= low:
+			return self.max_workers
+		return max(1, int(self.max_workers * self.remaining / low))
+
+	def refill(self):
+		now = time.monotonic()
+		self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+		self.refilled = now
+		if self.reset is not None and time.time() >= self.reset:
+			self.remaining = self.limit
+			self.reset = None
+
+	def has_quota(self) -> bool:
+		return self.remaining is None or self.remaining - self.reserved > self.reserve
+
+	def acquire(self, conditional: bool):
+		start = time.monotonic()
+		with self.cond:
+			while True:
+				self.refill()
+				if self.active < self.concurrency() and self.tokens >= 1 and (conditional or self.has_quota()):
+					self.waited += time.monotonic() - start
+					self.tokens -= 1
+					self.active += 1
+					if not conditional:
+						self.reserved += 1
+					return
+				timeout = None
+				if self.tokens < 1:
+					timeout = (1 - self.tokens) / self.rate
+				elif not conditional and not self.has_quota() and self.reset is not None:
+					timeout = max(self.reset - time.time(), 0.01)
+				self.cond.wait(timeout)
+
+	def release(self, resp: Optional[requests.Response], conditional: bool):
+		with self.cond:
+			self.active -= 1
+			if not conditional:
+				self.reserved -= 1
+			if resp is not None and "X-RateLimit-Remaining" in resp.headers:
+				limit = int(resp.headers["X-RateLimit-Limit"])
+				remaining = int(resp.headers["X-RateLimit-Remaining"])
+				reset = float(resp.headers["X-RateLimit-Reset"])
+				# responses can come back out of order, so within one window the lowest count is the latest
+				if reset != self.reset or self.remaining is None:
+					self.remaining = remaining
+				else:
+					self.remaining = min(self.remaining, remaining)
+				self.limit = limit
+				self.reset = reset
+			self.cond.notify_all()
+
+	def retry_delay(self, resp: requests.Response, attempt: int) -> Optional[float]:
+		"""How long to wait before retrying `resp`, or `None` if it didn't hit a rate limit."""
+		if resp.status_code not in (403, 429):
+			return None
+		delay = retry_after(resp.headers["Retry-After"]) if "Retry-After" in resp.headers else None
+		if delay is not None:
+			return delay
+		if resp.headers.get("X-RateLimit-Remaining") == "0":
+			return max(float(resp.headers["X-RateLimit-Reset"]) - time.time(), 0)
+		if resp.status_code == 429 or "rate limit" in resp.text.lower():
+			return min(self.backoff * 2 ** attempt, 60)
+		return None
+
+	def request(self, method: str, url: str, headers: dict=None, **kwargs) -> requests.Response:
+		"""
+		Make a request once the rate limits allow it. If it still gets rate limited, it's retried up to `max_retries`
+		times, then `RateLimited` is raised.
+		"""
+		conditional = bool(headers and headers.get("If-None-Match"))
+		for attempt in range(self.max_retries + 1):
+			self.acquire(conditional)
+			resp = None
+			try:
+				resp = self.session.request(method, url, headers=headers, **kwargs)
+			finally:
+				self.release(resp, conditional)
+			delay = self.retry_delay(resp, attempt)
+			if delay is None:
+				return resp
+			if attempt == self.max_retries:
+				raise RateLimited(f"still rate limited ({resp.status_code}) after {self.max_retries} retries: {url}", response=resp)
+			print(f"rate limited ({resp.status_code}): retrying {url} in {delay:.1f}s")
+			with self.cond:
+				self.retries += 1
+				self.waited += delay
+			time.sleep(delay)
+
+	def get(self, url: str, headers: dict=None, **kwargs) -> requests.Response:
+		return self.request("GET", url, headers=headers, **kwargs)
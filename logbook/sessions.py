@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Group commits into coding sessions.
+
+A session is a run of commits by one author in one repo, with no more than `gap` between consecutive commits. Its
+time spent is the time from the first commit to the last, but at least `min_duration`.
+
+Timestamps are parsed once, into seconds since the epoch, and sessions are built in one pass. `sessionize` streams:
+given commits in time order it yields each session as soon as it's been quiet for longer than `gap`, so only open
+sessions are held in memory, however long the history is.
+
+	./sessions.py commits.csv --gap 180 --min-duration 20 > logbook.csv
+
+reads commits exported as CSV with `time,author,repo,sha,message` columns.
+"""
+
+import sys
+import csv
+import heapq
+import argparse
+import datetime
+from typing import Iterable, Iterator, Optional, TextIO
+
+GAP = datetime.timedelta(hours=3)
+MIN_DURATION = datetime.timedelta(minutes=20)
+CSV_HEADER = ["date", "project", "languages", "lines of code", "time spent", "reflection"]
+
+def parse_time(s: str) -> int:
+	"""Seconds since the epoch of a GitHub timestamp like `2021-04-01T10:00:00Z`."""
+	return int(datetime.datetime.fromisoformat(s.rstrip("Z")).replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def format_time(t: int) -> str:
+	return datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class Commit:
+	__slots__ = ("time", "author", "repo", "sha", "message", "url")
+
+	def __init__(self, time: int, author: str, repo: str, sha: str, message: str, url: str=None):
+		self.time = time
+		self.author = author
+		self.repo = repo
+		self.sha = sha
+		self.message = message
+		self.url = url
+
+	def to_list(self) -> list:
+		return [self.time, self.author, self.repo, self.sha, self.message, self.url]
+
+	@classmethod
+	def from_list(cls, values: list) -> "Commit":
+		return cls(*values)
+
+class Session:
+	__slots__ = ("author", "repo", "commits", "counted", "additions", "deletions", "languages")
+
+	def __init__(self, author: str, repo: str):
+		self.author = author
+		self.repo = repo
+		self.commits: "list[Commit]" = []
+		# how many of the commits have had their line counts and languages added
+		self.counted = 0
+		self.additions = 0
+		self.deletions = 0
+		self.languages: "list[str]" = []
+
+	@property
+	def start(self) -> int:
+		return self.commits[0].time
+
+	@property
+	def end(self) -> int:
+		return self.commits[-1].time
+
+	def duration(self, min_duration: datetime.timedelta=MIN_DURATION) -> datetime.timedelta:
+		return max(datetime.timedelta(seconds=self.end - self.start), min_duration)
+
+	def to_dict(self) -> dict:
+		return {
+			"author": self.author,
+			"repo": self.repo,
+			"commits": [commit.to_list() for commit in self.commits],
+			"counted": self.counted,
+			"additions": self.additions,
+			"deletions": self.deletions,
+			"languages": self.languages,
+		}
+
+	@classmethod
+	def from_dict(cls, d: dict) -> "Session":
+		session = cls(d["author"], d["repo"])
+		session.commits = [Commit.from_list(values) for values in d["commits"]]
+		session.counted = d["counted"]
+		session.additions = d["additions"]
+		session.deletions = d["deletions"]
+		session.languages = d["languages"]
+		return session
+
+class Sessionizer:
+	"""Open sessions of every author and repo. Commits of each author and repo must be added in time order."""
+
+	def __init__(self, gap: datetime.timedelta=GAP):
+		self.gap = int(gap.total_seconds())
+		self.open: "dict[tuple[str, str], Session]" = {}
+		# (time the session closes, author, repo). Entries for sessions that have grown since are skipped.
+		self.deadlines: "list[tuple[int, str, str]]" = []
+
+	def resume(self, session: Session):
+		"""Continue a session that was left open, like one saved by an earlier run."""
+		self.open[(session.author, session.repo)] = session
+		heapq.heappush(self.deadlines, (session.end + self.gap, session.author, session.repo))
+
+	def add(self, commit: Commit) -> Optional[Session]:
+		"""Add a commit. If it's too long after its author's open session in the repo, that session is closed and returned."""
+		key = (commit.author, commit.repo)
+		session = self.open.get(key)
+		closed = None
+		if session is not None:
+			if commit.time < session.end:
+				raise ValueError(f"commit {commit.sha} is older than the commit before it in {commit.repo}")
+			if commit.time - session.end > self.gap:
+				closed = session
+				session = None
+		if session is None:
+			session = self.open[key] = Session(commit.author, commit.repo)
+		session.commits.append(commit)
+		heapq.heappush(self.deadlines, (commit.time + self.gap, commit.author, commit.repo))
+		return closed
+
+	def expire(self, now: int) -> "list[Session]":
+		"""Close and return the sessions that have been quiet for longer than the gap at `now`."""
+		closed = []
+		while self.deadlines and self.deadlines[0][0] < now:
+			deadline, author, repo = heapq.heappop(self.deadlines)
+			session = self.open.get((author, repo))
+			if session is not None and session.end + self.gap == deadline:
+				closed.append(self.open.pop((author, repo)))
+		return closed
+
+	def close_all(self) -> "list[Session]":
+		closed = list(self.open.values())
+		self.open.clear()
+		self.deadlines.clear()
+		return closed
+
+def sessionize(commits: "Iterable[Commit]", gap: datetime.timedelta=GAP) -> "Iterator[Session]":
+	"""Yield the sessions of `commits`, which must be in time order, in the order they close."""
+	sessionizer = Sessionizer(gap)
+	last = None
+	for commit in commits:
+		if last is not None and commit.time < last:
+			raise ValueError(f"commit {commit.sha} is out of order")
+		last = commit.time
+		yield from sessionizer.expire(commit.time)
+		closed = sessionizer.add(commit)
+		if closed is not None:
+			yield closed
+	yield from sorted(sessionizer.close_all(), key=lambda session: session.end)
+
+def read_commits(f: TextIO) -> "Iterator[Commit]":
+	"""Read commits from CSV with `time,author,repo,sha,message` columns, one row at a time."""
+	for row in csv.DictReader(f):
+		yield Commit(parse_time(row["time"]), row["author"], row["repo"], row["sha"], row["message"])
+
+def write_csv(f: TextIO, sessions: "Iterable[Session]", min_duration: datetime.timedelta=MIN_DURATION, header: bool=True):
+	writer = csv.writer(f, lineterminator="\n")
+	if header:
+		writer.writerow(CSV_HEADER)
+	for session in sessions:
+		writer.writerow([
+			format_time(session.start),
+			session.repo,
+			", ".join(session.languages),
+			f"+{session.additions} / -{session.deletions}",
+			session.duration(min_duration),
+			", ".join(commit.message.replace("\n", " ") for commit in session.commits),
+		])
+
+def main(argv: "list[str]"=None):
+	parser = argparse.ArgumentParser(description="Group exported commits into coding sessions.")
+	parser.add_argument("file", help="CSV of commits in time order, with time,author,repo,sha,message columns. - for stdin.")
+	parser.add_argument("--gap", type=float, default=GAP.total_seconds() / 60, help="Minutes between commits that ends a session.")
+	parser.add_argument("--min-duration", type=float, default=MIN_DURATION.total_seconds() / 60, help="Minutes that a session counts for at least.")
+	args = parser.parse_args(argv)
+
+	f = sys.stdin if args.file == "-" else open(args.file, "r", newline="")
+	with f:
+		sessions = sessionize(read_commits(f), datetime.timedelta(minutes=args.gap))
+		write_csv(sys.stdout, sessions, datetime.timedelta(minutes=args.min_duration))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,633 @@
+import unittest
+import email.utils
+import threading
+import re
+import io
+import csv
+import json
+import time
+import tempfile
+import datetime
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl, urlencode
+
+import autologbook
+import cache
+import ratelimit
+import metrics
+import sessions
+from sessions import Commit, parse_time
+
+class FakeRedis(object):
+	"""Stand-in for the parts of `redis.Redis` that autologbook uses. Counts round trips."""
+	def __init__(self):
+		self.data: dict[str, bytes] = {}
+		self.lock = threading.Lock()
+		self.round_trips = 0
+
+	def count(self):
+		with self.lock:
+			self.round_trips += 1
+
+	@staticmethod
+	def encode(value) -> bytes:
+		return value if isinstance(value, bytes) else str(value).encode()
+
+	def exists(self, *keys) -> int:
+		self.count()
+		return sum(1 for key in keys if key in self.data)
+
+	def delete(self, *keys) -> int:
+		self.count()
+		with self.lock:
+			return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+	def get(self, key):
+		self.count()
+		return self.data.get(key)
+
+	def mget(self, keys):
+		self.count()
+		return [self.data.get(key) for key in keys]
+
+	def set(self, key, value):
+		self.count()
+		with self.lock:
+			self.data[key] = self.encode(value)
+		return True
+
+	def mset(self, mapping: dict):
+		self.count()
+		with self.lock:
+			for key, value in mapping.items():
+				self.data[key] = self.encode(value)
+		return True
+
+	def pipeline(self, transaction=True):
+		return FakePipeline(self)
+
+class FakePipeline(object):
+	"""Queues commands and runs them against the `FakeRedis` as one round trip."""
+	def __init__(self, redis: FakeRedis):
+		self.redis = redis
+		self.commands = []
+
+	def __getattr__(self, name):
+		return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+	def execute(self):
+		self.redis.count()
+		round_trips = self.redis.round_trips
+		results = [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+		self.redis.round_trips = round_trips
+		self.commands = []
+		return results
+
+class FakeClock(object):
+	"""
+	Stand-in for the `time` module in `ratelimit`. Sleeping, or waiting on the scheduler, moves the wall clock forward
+	instead of blocking, so tests about resets don't depend on how long they take to run.
+	"""
+	monotonic = staticmethod(time.monotonic)
+
+	def __init__(self, now: float=1_000_000.0):
+		self.now = now
+
+	def time(self) -> float:
+		return self.now
+
+	def sleep(self, seconds: float):
+		self.now += seconds
+
+	def wait(self, timeout: float=None) -> bool:
+		self.now += timeout or 0
+		return False
+
+	def install(self, test: unittest.TestCase, scheduler: ratelimit.Scheduler):
+		for patch in (mock.patch.object(ratelimit, "time", self), mock.patch.object(scheduler.cond, "wait", self.wait)):
+			patch.start()
+			test.addCleanup(patch.stop)
+
+class StubGitHub(object):
+	"""
+	Local HTTP server that serves canned JSON the way the GitHub API does. `routes` maps a path to either a list of
+	items (for paged listings, split into pages by the `page` and `per_page` query parameters, with a Link header) or a
+	single JSON document, or a function that answers a POSTed JSON document. Commit listings are filtered by the
+	`since` query parameter.
+
+	`errors` maps a path, or a path with its query string, to `(status, headers)` responses to send before serving it
+	normally, and `remaining` and `reset` are sent as the rate limit.
+	"""
+	def __init__(self, routes: dict):
+		self.routes = routes
+		self.errors: dict[str, list[tuple[int, dict]]] = {}
+		self.remaining = 4999
+		self.reset = None
+		self.requests: list[str] = []
+		self.active = 0
+		self.max_active = 0
+		self.lock = threading.Lock()
+		stub = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def log_message(self, *args):
+				pass
+
+			def do_POST(self):
+				self.body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+				self.do_GET()
+
+			def do_GET(self):
+				with stub.lock:
+					stub.requests.append(self.path)
+					stub.active += 1
+					stub.max_active = max(stub.max_active, stub.active)
+				try:
+					time.sleep(0.01)
+					stub.respond(self)
+				finally:
+					with stub.lock:
+						stub.active -= 1
+
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+
+	def respond(self, handler: BaseHTTPRequestHandler):
+		url = urlparse(handler.path)
+		query = dict(parse_qsl(url.query))
+		route = self.routes.get(url.path)
+		links = []
+		headers = {
+			"X-RateLimit-Limit": "5000",
+			"X-RateLimit-Remaining": str(self.remaining),
+			"X-RateLimit-Reset": str(self.reset or int(time.time()) + 3600),
+		}
+		with self.lock:
+			key = handler.path if handler.path in self.errors else url.path
+			error = self.errors.get(key) and self.errors[key].pop(0)
+		if error:
+			status, extra = error
+			headers.update(extra)
+			body = {"message": "API rate limit exceeded" if status in (403, 429) else "error"}
+		elif route is None:
+			body, status = {"message": "Not Found"}, 404
+		elif callable(route):
+			body, status = route(handler.body), 200
+		elif isinstance(route, list):
+			if "since" in query:
+				route = [item for item in route if item["commit"]["author"]["date"] >= query["since"]]
+			page = max(int(query.get("page", 1)), 1)
+			per_page = min(int(query.get("per_page", 30)), 100)
+			last = max((len(route) + per_page - 1) // per_page, 1)
+			body, status = route[(page - 1) * per_page:page * per_page], 200
+			link = lambda p, rel: f'<{self.url}{url.path}?{urlencode({**query, "page": p})}>; rel="{rel}"'
+			if page > 1:
+				links += [link(page - 1, "prev"), link(1, "first")]
+			if page < last:
+				links += [link(page + 1, "next"), link(last, "last")]
+		else:
+			body, status = route, 200
+		payload = json.dumps(body).encode()
+		etag = f'"{hash(payload)}"'
+		if status == 200 and handler.headers.get("If-None-Match") == etag:
+			status, payload = 304, b""
+		handler.send_response(status)
+		handler.send_header("Content-Type", "application/json")
+		handler.send_header("Content-Length", str(len(payload)))
+		handler.send_header("ETag", etag)
+		if links:
+			handler.send_header("Link", ", ".join(links))
+		for name, value in headers.items():
+			handler.send_header(name, value)
+		handler.end_headers()
+		handler.wfile.write(payload)
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+class LogbookTestCase(unittest.TestCase):
+	routes: dict = {}
+
+	def setUp(self):
+		self.stub = StubGitHub(self.routes)
+		self.redis = FakeRedis()
+		self.original = autologbook.cache, autologbook.BASE_URL, autologbook.scheduler, autologbook.graphql_scheduler, autologbook.metrics
+		autologbook.cache = cache.Cache(cache.RedisBackend(self.redis))
+		autologbook.scheduler = ratelimit.Scheduler(autologbook.http, max_workers=autologbook.MAX_WORKERS, rate=1000, burst=1000, backoff=0.01)
+		autologbook.graphql_scheduler = ratelimit.Scheduler(autologbook.http, max_workers=autologbook.MAX_WORKERS, rate=1000, burst=1000, backoff=0.01)
+		autologbook.metrics = metrics.Metrics().install(autologbook.cache, autologbook.scheduler)
+		autologbook.BASE_URL = self.stub.url
+		autologbook.get_token.cache_clear()
+		autologbook.os.environ["GITHUB_TOKEN"] = "test"
+
+	def tearDown(self):
+		autologbook.metrics.uninstall()
+		autologbook.cache, autologbook.BASE_URL, autologbook.scheduler, autologbook.graphql_scheduler, autologbook.metrics = self.original
+		self.stub.close()
+
+def events(n: int, start: int=0) -> list:
+	return [{"id": str(i), "type": "PushEvent", "repo": {"name": f"dyc3/repo{i % 3}"}, "created_at": "2021-04-01T00:00:00Z"} for i in range(start, start + n)]
+
+class TestConcurrentFetch(LogbookTestCase):
+	routes = {
+		"/users/dyc3/events/public": events(267),
+		"/users/few/events/public": events(12),
+		"/users/none/events/public": [],
+	}
+
+	def test_fetch_many_keeps_order(self):
+		self.assertEqual(autologbook.fetch_many(lambda x: x * 2, range(50), workers=4), [x * 2 for x in range(50)])
+
+	def test_all_events_in_order(self):
+		got = [event["id"] for event in autologbook.get_all_events("dyc3")]
+		self.assertEqual(got, [str(i) for i in range(267)])
+		self.assertLessEqual(self.stub.max_active, autologbook.MAX_WORKERS)
+		# a second run revalidates with etags and gets the same result from the cache
+		got = [event["id"] for event in autologbook.get_all_events("dyc3")]
+		self.assertEqual(got, [str(i) for i in range(267)])
+
+	def pages_requested(self) -> "list[int]":
+		return [int(dict(parse_qsl(urlparse(path).query))["page"]) for path in self.stub.requests]
+
+	def test_pages_from_link_header(self):
+		self.assertEqual(len(list(autologbook.get_all_events("dyc3"))), 267)
+		# 100 per page, and the last page number comes from the Link header, so no empty page is requested
+		self.assertEqual(sorted(self.pages_requested()), [1, 2, 3])
+		self.assertTrue(all("per_page=100" in path for path in self.stub.requests))
+
+	def test_failed_page(self):
+		self.stub.errors["/users/dyc3/events/public?page=2&per_page=100"] = [(500, {})]
+		got = []
+		with self.assertRaises(autologbook.requests.HTTPError):
+			for event in autologbook.get_all_events("dyc3"):
+				got.append(event["id"])
+		self.assertEqual(got, [str(i) for i in range(100)])
+
+	def test_single_page(self):
+		self.assertEqual(len(list(autologbook.get_all_events("few"))), 12)
+		self.assertEqual(self.pages_requested(), [1])
+		self.assertEqual(list(autologbook.get_all_events("none")), [])
+		self.assertEqual(self.pages_requested(), [1, 1])
+
+	def test_last_page_of(self):
+		resp = autologbook.requests.Response()
+		resp.status_code = 304
+		self.assertIsNone(autologbook.last_page_of(resp, 1))
+		resp.headers["Link"] = '<https://api.github.com/x?page=1&per_page=100>; rel="prev"'
+		self.assertEqual(autologbook.last_page_of(resp, 2), 2)
+		resp.headers["Link"] = '<https://api.github.com/x?page=2&per_page=100>; rel="next", <https://api.github.com/x?page=9&per_page=100>; rel="last"'
+		self.assertEqual(autologbook.last_page_of(resp, 1), 9)
+
+class TestRedisCache(LogbookTestCase):
+	routes = {
+		"/repos/dyc3/repo0": {"name": "repo0"},
+	}
+
+	def get(self):
+		return autologbook.cached_get_one(f"{self.stub.url}/repos/dyc3/repo0", "repo:dyc3/repo0")
+
+	def test_round_trips(self):
+		self.assertEqual(self.get(), {"name": "repo0"})
+		# one MGET before the request, one pipeline after it
+		self.assertEqual(self.redis.round_trips, 2)
+		self.redis.round_trips = 0
+		self.assertEqual(self.get(), {"name": "repo0"})
+		# revalidated with a 304, served from memory
+		self.assertEqual(self.redis.round_trips, 0)
+		autologbook.cache.forget()
+		self.assertEqual(self.get(), {"name": "repo0"})
+		# served from what the MGET returned
+		self.assertEqual(self.redis.round_trips, 1)
+
+	def test_result_without_etag(self):
+		self.redis.set("repo:dyc3/repo0:result", json.dumps({"name": "stale"}))
+		self.assertEqual(self.get(), {"name": "repo0"})
+		self.assertIsNotNone(self.redis.data.get("repo:dyc3/repo0:etag"))
+
+	def test_etag_without_result(self):
+		self.get()
+		etag = self.redis.data["repo:dyc3/repo0:etag"]
+		self.redis.delete("repo:dyc3/repo0:result")
+		autologbook.cache.forget()
+		self.assertEqual(self.get(), {"name": "repo0"})
+		self.assertEqual(self.redis.data["repo:dyc3/repo0:etag"], etag)
+
+	def test_prefetch(self):
+		self.redis.mset({"a:etag": "1", "a:result": "[]", "b:etag": "2"})
+		self.redis.round_trips = 0
+		self.assertEqual(autologbook.prefetch(["a", "b", "c"]), [("1", []), (None, None), (None, None)])
+		self.assertEqual(self.redis.round_trips, 1)
+		self.assertEqual(autologbook.prefetch(["a"]), [("1", [])])
+		self.assertEqual(self.redis.round_trips, 1)
+
+class TestCache(unittest.TestCase):
+	def backends(self, directory: str) -> list:
+		return [cache.RedisBackend(FakeRedis()), cache.SQLiteBackend(f"{directory}/cache.db"), cache.DirectoryBackend(f"{directory}/cache")]
+
+	def test_backends(self):
+		document = {"items": [{"sha": str(i), "message": "fix the thing"} for i in range(100)]}
+		with tempfile.TemporaryDirectory() as directory:
+			for backend in self.backends(directory):
+				with self.subTest(backend=type(backend).__name__):
+					self.assertEqual(cache.Cache(backend).put("a", json.dumps(document), '"etag"'), document)
+					cache.Cache(backend).put("b", "[1]", None)
+					self.assertEqual(cache.Cache(backend).get_many(["a", "b", "c"]), [('"etag"', document), (None, [1]), (None, None)])
+					raw = backend.get_many(["a:result"])[0]
+					self.assertTrue(raw.startswith(cache.COMPRESSED))
+					self.assertLess(len(raw), len(json.dumps(document)))
+					cache.Cache(backend).put("a", "{}", None)
+					self.assertEqual(cache.Cache(backend).get_many(["a"]), [(None, {})])
+
+	def test_uncompressed_values(self):
+		redis = FakeRedis()
+		redis.mset({"a:etag": "1", "a:result": json.dumps(list(range(1000)))})
+		self.assertEqual(cache.Cache(cache.RedisBackend(redis)).get_many(["a"]), [("1", list(range(1000)))])
+
+	def test_eviction(self):
+		c = cache.Cache(cache.RedisBackend(FakeRedis()), max_bytes=10)
+		c.put("a", "[1, 2]", None)
+		c.put("b", "[3, 4]", None)
+		self.assertEqual(list(c.memory), ["b"])
+		self.assertEqual(c.size, 6)
+		c.get_many(["a"])
+		self.assertEqual(list(c.memory), ["a"])
+		c.put("big", json.dumps(list(range(100))), None)
+		self.assertEqual(list(c.memory), ["a"])
+		self.assertEqual((c.memory_hits, c.backend_hits, c.misses), (0, 1, 0))
+		c.get_many(["a", "nope"])
+		self.assertEqual((c.memory_hits, c.backend_hits, c.misses), (1, 1, 1))
+
+class TestMetrics(LogbookTestCase):
+	routes = {
+		"/repos/dyc3/repo0": {"name": "repo0"},
+		"/repos/dyc3/repo0/commits/abc": {"stats": {"additions": 1, "deletions": 0}, "files": []},
+		"/repos/dyc3/missing": None,
+	}
+
+	def test_requests(self):
+		url = f"{self.stub.url}/repos/dyc3/repo0"
+		autologbook.cached_get_one(url, "repo:dyc3/repo0")
+		autologbook.cached_get_one(url, "repo:dyc3/repo0")
+		autologbook.cached_get_one(f"{url}/commits/abc", "commit:dyc3/repo0:abc", is_constant=True)
+		autologbook.cached_get_one(f"{url}/commits/abc", "commit:dyc3/repo0:abc", is_constant=True)
+		autologbook.cached_get_one(f"{self.stub.url}/repos/dyc3/missing", "repo:dyc3/missing")
+		summary = autologbook.metrics.summary()
+		repo = summary["endpoints"]["repo"]
+		self.assertEqual((repo["200"], repo["304"], repo["error"], repo["cached"]), (1, 1, 1, 0))
+		self.assertEqual(repo["latency"]["count"], 3)
+		self.assertEqual((summary["endpoints"]["commit"]["200"], summary["endpoints"]["commit"]["cached"]), (1, 1))
+		self.assertEqual(summary["bytes_from_cache"], len('{"name": "repo0"}') + len(json.dumps(self.routes["/repos/dyc3/repo0/commits/abc"])))
+		# the 304 doesn't count against the quota
+		self.assertEqual(summary["rate_limit"]["core"]["used"], 3)
+		self.assertEqual(summary["backend"]["get"]["count"], 3)
+		self.assertEqual(summary["backend"]["write"]["count"], 2)
+		self.assertEqual(summary["decode"]["count"], 2)
+		self.assertEqual(summary["cache"], {"memory_hits": 2, "backend_hits": 0, "misses": 3})
+		out = io.StringIO()
+		autologbook.metrics.report(out)
+		self.assertIn("repo", out.getvalue())
+		with tempfile.TemporaryDirectory() as directory:
+			autologbook.metrics.export(f"{directory}/metrics.json")
+			with open(f"{directory}/metrics.json", "r") as f:
+				self.assertEqual(json.load(f)["endpoints"]["repo"]["200"], 1)
+
+	def test_timings(self):
+		timings = metrics.Timings()
+		self.assertEqual(timings.to_dict()["p50_ms"], 0)
+		for ms in [5, 1, 4, 2, 3, 100, 6, 7, 8, 9]:
+			timings.add(ms / 1000)
+		stats = timings.to_dict()
+		self.assertEqual(stats["count"], 10)
+		self.assertAlmostEqual(stats["total_ms"], 145)
+		self.assertAlmostEqual(stats["p50_ms"], 5)
+		self.assertAlmostEqual(stats["p90_ms"], 9)
+		self.assertAlmostEqual(stats["p99_ms"], 100)
+
+	def test_uninstall(self):
+		backend = autologbook.cache.backend.backend
+		autologbook.metrics.uninstall()
+		self.assertIs(autologbook.cache.backend, backend)
+		self.assertNotIn("load", vars(autologbook.cache))
+
+class TestRateLimit(LogbookTestCase):
+	routes = {
+		"/repos/dyc3/repo0": {"name": "repo0"},
+	}
+
+	def get(self):
+		return autologbook.cached_get_one(f"{self.stub.url}/repos/dyc3/repo0", "repo:dyc3/repo0")
+
+	def test_secondary_limit_retried(self):
+		self.stub.errors["/repos/dyc3/repo0"] = [(429, {"Retry-After": "0"}), (403, {}), (403, {})]
+		self.assertEqual(self.get(), {"name": "repo0"})
+		self.assertEqual(autologbook.scheduler.retries, 3)
+		self.assertEqual(len(self.stub.requests), 4)
+
+	def test_retry_after_date(self):
+		clock = FakeClock()
+		clock.install(self, autologbook.scheduler)
+		start = clock.now
+		self.stub.errors["/repos/dyc3/repo0"] = [(429, {"Retry-After": email.utils.formatdate(start + 30, usegmt=True)})]
+		self.assertEqual(self.get(), {"name": "repo0"})
+		self.assertGreaterEqual(clock.now, start + 29)
+
+	def test_gives_up(self):
+		self.stub.errors["/repos/dyc3/repo0"] = [(429, {"Retry-After": "0"})] * 6
+		with self.assertRaises(ratelimit.RateLimited) as raised:
+			self.get()
+		self.assertEqual(raised.exception.response.status_code, 429)
+		self.assertEqual(len(self.stub.requests), 6)
+
+	def test_other_errors_not_retried(self):
+		self.stub.errors["/repos/dyc3/repo0"] = [(404, {})]
+		self.assertIsNone(self.get())
+		self.assertEqual(len(self.stub.requests), 1)
+
+	def test_waits_for_reset(self):
+		clock = FakeClock()
+		clock.install(self, autologbook.scheduler)
+		reset = int(clock.now) + 60
+		self.stub.errors["/repos/dyc3/repo0"] = [(403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)})]
+		self.assertEqual(self.get(), {"name": "repo0"})
+		self.assertGreaterEqual(clock.now, reset)
+
+	def test_quota(self):
+		clock = FakeClock()
+		clock.install(self, autologbook.scheduler)
+		self.stub.remaining = 0
+		self.stub.reset = int(clock.now) + 60
+		self.get()
+		scheduler = autologbook.scheduler
+		self.assertEqual((scheduler.remaining, scheduler.concurrency()), (0, 1))
+		# a revalidation doesn't count against the quota, so it doesn't wait for the reset
+		self.get()
+		self.assertLess(clock.now, self.stub.reset)
+		autologbook.cache.forget()
+		self.redis.data.clear()
+		self.get()
+		self.assertGreaterEqual(clock.now, self.stub.reset)
+
+	def test_concurrency(self):
+		scheduler = ratelimit.Scheduler(None, max_workers=8)
+		self.assertEqual(scheduler.concurrency(), 8)
+		scheduler.limit = 5000
+		for remaining, concurrency in [(5000, 8), (500, 8), (250, 4), (10, 1), (0, 1)]:
+			scheduler.remaining = remaining
+			self.assertEqual(scheduler.concurrency(), concurrency)
+
+def commit(base: str, sha: str, date: str) -> dict:
+	return {
+		"sha": sha,
+		"url": f"{base}/repos/dyc3/proj/commits/{sha}",
+		"commit": {"author": {"date": date}, "message": f"commit {sha}"},
+		"author": {"login": "dyc3"},
+		"committer": {"login": "dyc3"},
+	}
+
+class TestIncremental(LogbookTestCase):
+	def setUp(self):
+		super().setUp()
+		self.directory = tempfile.TemporaryDirectory()
+		self.output = f"{self.directory.name}/logbook.csv"
+		self.state = f"{self.directory.name}/state.json"
+		base = self.stub.url
+		self.commits = [
+			commit(base, "a1", "2021-04-01T10:00:00Z"),
+			commit(base, "a2", "2021-04-01T10:30:00Z"),
+			commit(base, "b1", "2021-04-01T15:00:00Z"),
+		]
+		self.stub.routes = {
+			"/users/dyc3/events/public": [{"id": "1", "type": "PushEvent", "repo": {"name": "dyc3/proj", "url": f"{base}/repos/dyc3/proj"}, "created_at": "2021-04-01T10:00:00Z"}],
+			"/repos/dyc3/proj/commits": self.commits,
+		}
+		for sha in ["a1", "a2", "b1", "b2", "c1"]:
+			self.stub.routes[f"/repos/dyc3/proj/commits/{sha}"] = {"stats": {"additions": 10, "deletions": 1}, "files": [{"filename": f"{sha}.py"}]}
+		self.stub.routes["/graphql"] = self.graphql
+		self.stub.routes["/repos/dyc3/proj/commits/b1"]["files"] = []
+
+	def graphql(self, request: dict) -> dict:
+		"""Answer commit stats queries from the REST commits."""
+		data = {}
+		for alias, owner, name, sha in re.findall(r'(\w+): (?:repository\(owner: "([^"]+)", name: "([^"]+)"\)|object\(oid: "([^"]+)"\))', request["query"]):
+			if owner:
+				repo = data[alias] = {}
+				path = f"/repos/{owner}/{name}/commits"
+				continue
+			commit = self.stub.routes.get(f"{path}/{sha}")
+			repo[alias] = commit and {**commit["stats"], "changedFilesIfAvailable": len(commit["files"])}
+		return {"data": data}
+
+	def tearDown(self):
+		super().tearDown()
+		self.directory.cleanup()
+
+	def run_logbook(self, now: str, state: bool=True, **kwargs) -> "list[sessions.Session]":
+		return autologbook.run("dyc3", "2021-03-30", self.output, self.state if state else None, now=parse_time(now), **kwargs)
+
+	def detail_requests(self) -> "list[str]":
+		return sorted(path.rsplit("/", 1)[1] for path in self.stub.requests if path.startswith("/repos/dyc3/proj/commits/"))
+
+	def test_graphql(self):
+		self.commits.append(commit(self.stub.url, "zz", "2021-04-01T15:30:00Z"))
+		sessions = self.run_logbook("2021-04-01T16:00:00Z", state=False, bulk=True, languages=False)
+		self.assertEqual([(s.additions, s.deletions, s.languages) for s in sessions], [(20, 2, []), (10, 1, [])])
+		self.assertEqual(self.detail_requests(), ["zz"])
+		self.assertEqual(self.stub.requests.count("/graphql"), 1)
+		self.assertIsNone(self.redis.data.get("commit:dyc3/proj:zz:result"))
+		self.assertIsNotNone(self.redis.data.get("commit:dyc3/proj:a1:result"))
+
+	def test_graphql_with_languages(self):
+		sessions = self.run_logbook("2021-04-01T16:00:00Z", state=False, bulk=True)
+		self.assertEqual([(s.additions, s.languages) for s in sessions], [(20, ["Python"]), (10, [])])
+		# b1 changed no files, so its file list didn't need the REST API
+		self.assertEqual(self.detail_requests(), ["a1", "a2"])
+		self.stub.requests.clear()
+		self.run_logbook("2021-04-01T16:00:00Z", state=False, bulk=True)
+		self.assertEqual(self.detail_requests(), [])
+		self.assertNotIn("/graphql", self.stub.requests)
+
+	def rows(self) -> "list[str]":
+		with open(self.output, "r", newline="") as f:
+			return [f"{row[0]} {row[3]}" for row in list(csv.reader(f))[1:]]
+
+	def test_full(self):
+		sessions = self.run_logbook("2021-04-01T16:00:00Z", state=False)
+		self.assertEqual([len(session.commits) for session in sessions], [2, 1])
+		self.assertEqual(self.rows(), ["2021-04-01T10:00:00Z +20 / -2", "2021-04-01T15:00:00Z +10 / -1"])
+
+	def test_incremental(self):
+		self.run_logbook("2021-04-01T16:00:00Z")
+		# the second session could still grow, so it's kept in the state instead of written
+		self.assertEqual(self.rows(), ["2021-04-01T10:00:00Z +20 / -2"])
+		self.commits.append(commit(self.stub.url, "b2", "2021-04-01T16:00:00Z"))
+		self.commits.append(commit(self.stub.url, "c1", "2021-04-02T09:00:00Z"))
+		self.stub.requests.clear()
+		sessions = self.run_logbook("2021-04-02T10:00:00Z")
+		self.assertEqual([[c.sha for c in session.commits] for session in sessions], [["b1", "b2"]])
+		self.assertEqual(self.rows(), ["2021-04-01T10:00:00Z +20 / -2", "2021-04-01T15:00:00Z +20 / -2"])
+		# c1 is still open, but its details are kept with it
+		self.assertEqual(self.detail_requests(), ["b2", "c1"])
+		listing = [path for path in self.stub.requests if path.startswith("/repos/dyc3/proj/commits?")]
+		self.assertTrue(all("since=2021-04-01T15%3A00%3A00Z" in path for path in listing))
+		with open(self.state, "r") as f:
+			state = json.load(f)
+		self.assertEqual(state["watermarks"]["dyc3/proj"], {"time": parse_time("2021-04-02T09:00:00Z"), "shas": ["c1"]})
+		self.assertEqual([Commit.from_list(c).sha for c in state["open"][0]["commits"]], ["c1"])
+		# nothing new
+		self.assertEqual(self.run_logbook("2021-04-02T10:30:00Z"), [])
+		self.assertEqual(self.run_logbook("2021-04-03T00:00:00Z")[0].commits[0].sha, "c1")
+		self.assertEqual(len(self.rows()), 3)
+
+class TestSessions(unittest.TestCase):
+	def commits(self, *rows: "tuple[str, str, str]") -> "list[Commit]":
+		return [Commit(parse_time(f"2021-04-01T{time}:00Z"), author, repo, f"{author}{i}", f"message {i}") for i, (time, author, repo) in enumerate(rows)]
+
+	def test_times(self):
+		self.assertEqual(parse_time("1970-01-01T01:00:00Z"), 3600)
+		self.assertEqual(sessions.format_time(parse_time("2021-04-01T10:30:00Z")), "2021-04-01T10:30:00Z")
+
+	def test_authors_and_repos(self):
+		commits = self.commits(
+			("10:00", "a", "x"),
+			("10:10", "b", "x"),
+			("10:20", "a", "y"),
+			("11:00", "a", "x"),
+			("15:00", "b", "x"),
+			("15:30", "a", "x"),
+		)
+		got = [(s.author, s.repo, [c.sha for c in s.commits]) for s in sessions.sessionize(commits)]
+		# sessions come out once they've been quiet for longer than the gap
+		self.assertEqual(got, [
+			("b", "x", ["b1"]),
+			("a", "y", ["a2"]),
+			("a", "x", ["a0", "a3"]),
+			("b", "x", ["b4"]),
+			("a", "x", ["a5"]),
+		])
+
+	def test_gap_and_duration(self):
+		commits = self.commits(("10:00", "a", "x"), ("10:05", "a", "x"), ("11:00", "a", "x"))
+		got = list(sessions.sessionize(commits, gap=datetime.timedelta(minutes=30)))
+		self.assertEqual([len(s.commits) for s in got], [2, 1])
+		self.assertEqual(got[0].duration(), datetime.timedelta(minutes=20))
+		self.assertEqual(got[0].duration(datetime.timedelta(0)), datetime.timedelta(minutes=5))
+
+	def test_out_of_order(self):
+		with self.assertRaises(ValueError):
+			list(sessions.sessionize(self.commits(("10:00", "a", "x"), ("09:00", "b", "x"))))
+
+	def test_csv(self):
+		exported = "time,author,repo,sha,message\n2021-04-01T10:00:00Z,a,x,1,\"fix, \"\"quoted\"\"\"\n2021-04-01T10:30:00Z,a,x,2,more\n"
+		out = io.StringIO()
+		sessions.write_csv(out, sessions.sessionize(sessions.read_commits(io.StringIO(exported))))
+		rows = list(csv.reader(io.StringIO(out.getvalue())))
+		self.assertEqual(rows, [sessions.CSV_HEADER, ["2021-04-01T10:00:00Z", "x", "", "+0 / -0", "0:30:00", 'fix, "quoted", more']])
+
+if __name__ == "__main__":
+	unittest.main()